@@ -1,67 +1,428 @@
-import math
-from gen_test_data import load_json, write_json, ANIME
-from prob import shuffle, pmfs
-from query import query, check, mean
+import array, asyncio, bisect, collections.abc, heapq, math
+from gen_test_data import write_json
+from prob import shuffle, pmfs, plan_batches, plan_depth, hypergeometric, \
+    Permutation, M
+from query import Session, query_ids, check, mean, visit
+import query
 
-SHUFFLE = True # randomize order 
-WRITE = True   # write list to file
-MEAN = mean()  # list average
+SHUFFLE = True   # randomize order 
+WRITE = True     # write list to file
+PIPELINE = False # compute scores while the list is still being searched
+IMPLICIT = False # compute leaves on demand instead of storing the tree
+SEARCH = "tree"  # "tree", "counts", "split" (hwang) or "scheduled"
+VECTORIZE = False # reconstruct the scores of all batches at once with numpy
+JOBS = 1         # number of batches queried concurrently
+INSTRUMENT = None # JSON lines file for oracle and search counters, if any
+TARGET = 0.99    # chance of recovering every score when sizing batches
+MEAN = None      # list average, asked of the oracle on first use
+
+def average() -> float:
+    """ The list average, asking the oracle for it the first time. """
+    global MEAN
+    if MEAN is None: MEAN = mean()
+    return MEAN
 
 def to_list(names: list, scores: list=None) -> dict:
     """ Creates a dictionary out of the names and scores lists. """
-    # change round(MEAN) to 1 to not use the given mean
-    if scores is None: scores = [round(MEAN)]*len(names)
+    # change round(average()) to 1 to not use the given mean
+    if scores is None: scores = [round(average())]*len(names)
     return dict(zip(names, scores))
 
 ### part 1: find the anime that is in the list
 
-def make_tree(l: list) -> list:
-    """ Converts a list into a binary search tree. """
+PAD = -1 # id of the padding leaves
+
+def make_tree(l: list) -> array.array:
+    """ Converts a list of ids into the leaves of a complete binary tree.
+    A node is the range [start, end) of the leaves it covers. """
     n = 1 << (len(l) - 1).bit_length() # nearest greater power of 2
-    leaves = shuffle(l + (n - len(l))*[None], SHUFFLE)
-    # full binary tree with n leaves will have n - 1 internal nodes
-    return [None] + [0]*(len(leaves) - 1) + leaves
+    return array.array("l", shuffle(l + (n - len(l))*[PAD], SHUFFLE))
+
+class PermutedTree(collections.abc.Sequence):
+    """ Leaves of a tree over the ids 0, ..., n - 1 computed on demand: leaf
+    i holds the image of i under a seeded permutation of the leaves, images
+    n and above being padding, so the padding is spread out like make_tree's.
+    If spread is False, the ids are permuted among themselves and the
+    padding all comes after the last id, so it is located arithmetically. """
+
+    def __init__(self, n: int, permute: bool=True, spread: bool=True) -> None:
+        self.n, self.size = n, 1 << (n - 1).bit_length()
+        # leaves at or past domain are padding without asking the permutation
+        self.domain = self.size if spread else n
+        self.permutation = Permutation(self.domain) if permute else None
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self.size))]
+        if i < 0: i += self.size
+        if not 0 <= i < self.size: raise IndexError("leaf index out of range")
+        if i >= self.domain: return PAD
+        x = i if self.permutation is None else self.permutation(i)
+        return x if x < self.n else PAD
+
+    def contiguous(self) -> bool:
+        """ Whether the padding is exactly the leaves after the last id. """
+        return self.permutation is None or self.domain == self.n
+
+    def leaves(self, start: int, end: int):
+        """ The ids in [start, end), the padding is skipped entirely. """
+        ids = range(start, max(start, min(end, self.domain)))
+        if self.permutation is None: return ids
+        ids = map(self.permutation, ids)
+        return ids if self.domain == self.n else (x for x in ids if x < self.n)
+
+    def live(self, start: int, end: int) -> int:
+        """ The number of ids in [start, end). """
+        if self.contiguous():
+            return max(0, min(end, self.n) - start)
+        return sum(1 for _ in self.leaves(start, end))
+
+    def padding(self) -> list:
+        """ Sorted leaf positions of the padding. """
+        if self.contiguous():
+            return range(self.n, self.size)
+        return sorted(map(self.permutation.inverse, range(self.n, self.size)))
+
+def implicit_tree(n: int) -> PermutedTree:
+    """ Like make_tree(list(range(n))), but in constant memory. """
+    return PermutedTree(n, SHUFFLE)
 
-def empty(l: list) -> bool:
-    """ Determines whether any of the anime in l are in the list. """
-    return len(l) == 0 or query(to_list(l))[0] == 0
+def leaves(tree: array.array, start: int, end: int) -> memoryview:
+    """ Returns the leaves of the node without copying them. """
+    if isinstance(tree, PermutedTree):
+        return tree.leaves(start, end)
+    return memoryview(tree)[start:end]
 
-def depth(n: int) -> int:
+def padding(tree: array.array) -> list:
+    """ Sorted leaf positions of the padding. """
+    if isinstance(tree, PermutedTree):
+        return tree.padding()
+    return [i for i, x in enumerate(tree) if x == PAD]
+
+def node_ids(tree: array.array, start: int, end: int) -> frozenset:
+    """ The ids of the anime in the node, the padding is skipped. """
+    return frozenset(i for i in leaves(tree, start, end) if i >= 0)
+
+def empty(tree: array.array, start: int, end: int) -> bool:
+    """ Determines whether any of the anime in the node are in the list. """
+    ids = node_ids(tree, start, end)
+    return not ids or query_ids(ids, round(average()))[0] == 0
+
+def depth(tree: array.array, start: int, end: int) -> int:
     """ Returns the depth of a node. """
-    return n.bit_length() - 1
-
-def is_leaf(tree: list, n: int) -> bool:
-    """ Returns whether the node is a leaf. """
-    return depth(n) == (len(tree) - 1).bit_length() - 1
-    return (n << 1) >= len(tree) and ((n << 1) | 1) >= len(tree)
-
-def __children(tree: list, n: int, l: list) -> list:
-    """ Recursive helper method for children. """
-    if is_leaf(tree, n):
-        if tree[n] is not None:
-            l.append(tree[n])
-        return l
-    __children(tree,  n << 1, l)
-    __children(tree, (n << 1) | 1, l)
-    return l
-
-def children(tree: list, n: int) -> list:
-    """ Returns all children of node n. """
-    return __children(tree, n, [])
-
-def traverse(tree: list, n: int=1, l: list=[]) -> list:
-    """ Descend the tree to find which anime are contained. """
+    return len(tree).bit_length() - (end - start).bit_length()
+
+def traverse(tree: array.array, start: int=0, end: int=None):
+    """ Descend the tree to find which anime are contained,
+    yielding each one as soon as its leaf is confirmed. """
+    if end is None: end = len(tree)
+    visit(depth(tree, start, end))
     # if leaf and is valid anime, add to list
-    if is_leaf(tree, n):
-        if tree[n] is not None and not empty([tree[n]]):
-            l.append(tree[n])
-        return l
+    if end - start == 1:
+        if tree[start] != PAD and not empty(tree, start, end):
+            yield tree[start]
+        return
     # if tree contains valid anime, continue exploring, otherwise prune
-    if depth(n) <= DEPTH or not empty(children(tree, n)):
-        # node n has children at indexes 2n and 2n + 1 by design
-        traverse(tree,  n << 1)
-        traverse(tree, (n << 1) | 1)
-        return l
+    if depth(tree, start, end) <= DEPTH or not empty(tree, start, end):
+        # the children split the range of leaves in half
+        mid = (start + end) >> 1
+        yield from traverse(tree, start, mid)
+        yield from traverse(tree, mid, end)
+
+### count-aware search: use how many anime are shared, not just whether any are
+
+def count_in(l: list, start: int, end: int) -> int:
+    """ Number of elements of the sorted list l in [start, end). """
+    return bisect.bisect_left(l, end) - bisect.bisect_left(l, start)
+
+def live(tree: array.array, start: int, end: int, pad: list=None) -> int:
+    """ Returns the number of anime (non-padding leaves) in the node, from
+    the sorted leaf positions of the padding pad if they are given. """
+    if pad is not None:
+        return end - start - count_in(pad, start, end)
+    if isinstance(tree, PermutedTree):
+        return tree.live(start, end)
+    return end - start - tree[start:end].count(PAD)
+
+def count(tree: array.array, start: int, end: int) -> int:
+    """ Determines how many of the anime in the node are in the list. """
+    ids = node_ids(tree, start, end)
+    return 0 if not ids else query_ids(ids, round(average()))[0]
+
+def count_traverse(tree: array.array, start: int=0, end: int=None,
+                   c: int=None):
+    """ Like traverse, but c is the node's count if already known: the right
+    child's count is the parent's minus the left child's, and a node whose
+    count equals its number of anime is contained in the list entirely. """
+    if end is None: end = len(tree)
+    visit(depth(tree, start, end))
+    if c is None and (depth(tree, start, end) > DEPTH or end - start == 1):
+        c = count(tree, start, end)
+    if c == 0:
+        return
+    if c is not None and c == live(tree, start, end):
+        yield from (x for x in leaves(tree, start, end) if x != PAD)
+        return
+    mid = (start + end) >> 1
+    # the count of the node was skipped, so the children's are unknown too
+    if c is None:
+        yield from count_traverse(tree, start, mid)
+        yield from count_traverse(tree, mid, end)
+    else:
+        left = count(tree, start, mid)
+        yield from count_traverse(tree, start, mid, left)
+        yield from count_traverse(tree, mid, end, c - left)
+
+### adaptive group testing: Hwang's generalized binary splitting
+
+def split_group(ids: array.array, start: int, end: int, c: int):
+    """ Finds the c anime of the group [start, end) in the list by halving
+    the group, inferring the count of the right half from the left. """
+    if c == 0:
+        return
+    if c == end - start:
+        yield from leaves(ids, start, end)
+        return
+    mid = (start + end) >> 1
+    left = count(ids, start, mid)
+    yield from split_group(ids, start, mid, left)
+    yield from split_group(ids, mid, end, c - left)
+
+def split_search(tree: array.array):
+    """ Generalized binary splitting with counts. Groups are taken from the
+    front of the pool, sized by the number of anime still to be found. """
+    # an implicit pool keeps its padding after the last id instead
+    ids = PermutedTree(tree.n, tree.permutation is not None, False) \
+        if isinstance(tree, PermutedTree) else \
+        array.array("l", (x for x in tree if x != PAD))
+    # one query over the entire pool tells how many anime are left to find
+    n = live(ids, 0, len(ids))
+    d, p = count(ids, 0, n), 0
+    while d > 0:
+        rest = n - p
+        if d == rest:
+            yield from leaves(ids, p, n)
+            return
+        # test one at a time when at least about half of the pool is in the
+        # list, otherwise a group of 2^alpha likely holds exactly one
+        alpha = 0 if rest <= 2*d - 2 else int(math.log2((rest - d + 1)/d))
+        g = 1 << alpha
+        c = count(ids, p, p + g)
+        yield from split_group(ids, p, p + g, c)
+        d, p = d - c, p + g
+
+### transition-aware scheduling of the probes made by traverse
+
+def scheduled_traverse(tree: array.array):
+    """ Probes the same nodes as traverse, but picks the pending probe which
+    is cheapest to reach from the previous query. A node is always contained
+    in or disjoint from the previous one, so going to a child of a positive
+    node costs |prev| - |child| removals and jumping elsewhere costs |prev| +
+    |node|: descend into the larger child if possible, else take the smallest
+    pending node. Sizes come from the padding positions, not set differences.
+    """
+    pad = padding(tree)
+    size = lambda start, end: live(tree, start, end, pad)
+    # heap of pending probes by size, nodes probed out of order are skipped
+    pending, probed = [], set()
+
+    def expand(start: int, end: int) -> None:
+        """ Adds the probes of the node's children, skipping shallow nodes. """
+        mid = (start + end) >> 1
+        for child in ((start, mid), (mid, end)):
+            if size(*child) == 0:
+                continue
+            if child[1] - child[0] > 1 and depth(tree, *child) <= DEPTH:
+                expand(*child)
+            else:
+                heapq.heappush(pending, (size(*child), *child))
+
+    if len(tree) == 1 or depth(tree, 0, len(tree)) > DEPTH:
+        heapq.heappush(pending, (size(0, len(tree)), 0, len(tree)))
+    else:
+        expand(0, len(tree))
+    children = None
+    while pending:
+        if children is not None:
+            # the larger child is closer to its parent
+            node = max(children, key=lambda c: size(*c))
+        else:
+            node = heapq.heappop(pending)[1:]
+            if node in probed:
+                continue
+        probed.add(node)
+        start, end = node
+        visit(depth(tree, start, end))
+        children = None
+        if empty(tree, start, end):
+            continue
+        if end - start == 1:
+            yield tree[start]
+            continue
+        expand(start, end)
+        mid = (start + end) >> 1
+        children = [c for c in ((start, mid), (mid, end)) if size(*c) > 0]
+
+searches = {"tree": traverse, "counts": count_traverse, "split": split_search,
+            "scheduled": scheduled_traverse}
+
+### population: traverse for many private lists at once
+
+def population_traverse(tree: array.array, oracle) -> tuple:
+    """ Runs traverse for every user of a query.PopulationOracle at once. A
+    node is asked about once for all users whose own traverse would ask
+    about it, so common queries are shared. Returns the ids found for each
+    user, the number of queries each user's traverse would have made and
+    the number of queries actually made. """
+    import numpy as np
+    oracle.arrange(list(tree))
+    found = [[] for _ in range(oracle.users)]
+    queries, before = np.zeros(oracle.users, np.int64), oracle.queries
+
+    def descend(start: int, end: int, users) -> None:
+        """ Visits the node for the users that reach it. """
+        # an empty node is pruned without a query
+        if live(tree, start, end) == 0:
+            return
+        leaf = end - start == 1
+        if leaf or depth(tree, start, end) > DEPTH:
+            queries[users] += 1
+            users = users[oracle.count_leaves(start, end, users) > 0]
+            if len(users) == 0:
+                return
+            if leaf:
+                for u in users.tolist():
+                    found[u].append(tree[start])
+                return
+        mid = (start + end) >> 1
+        descend(start, mid, users)
+        descend(mid, end, users)
+
+    descend(0, len(tree), np.arange(oracle.users))
+    return found, queries, oracle.queries - before
+
+### query accounting: the cost of a sequence of tree node queries
+
+class NodeQueries:
+    """ Accumulates the number of queries, total size, largest query,
+    additions and removals of a sequence of queries of tree nodes. """
+
+    def __init__(self) -> None:
+        self.stats, self.prev = [0, 0, 0, 0, 0], None
+
+    def ask(self, start: int, end: int, size: int) -> None:
+        """ Accounts for a query of the size anime in [start, end). """
+        s, p = self.stats, self.prev
+        if p is not None:
+            # tree nodes are either nested or disjoint, so the anime in both
+            # queries are all of the smaller node's or none
+            nested = p[0] <= start and end <= p[1] or \
+                start <= p[0] and p[1] <= end
+            both = min(size, p[2]) if nested else 0
+            s[3], s[4] = s[3] + size - both, s[4] + p[2] - both
+        s[0], s[1], s[2] = s[0] + 1, s[1] + size, max(s[2], size)
+        self.prev = (start, end, size)
+
+    def totals(self) -> tuple:
+        """ Queries, total size, largest query, additions and removals. """
+        return tuple(self.stats)
+
+### depth sweep: the queries of every DEPTH from a single traversal
+
+def sweep(tree: array.array, positives: list, padding: list,
+          depths: list) -> dict:
+    """ Computes the number of queries, total size, largest query, additions
+    and removals traverse would use for each DEPTH in depths, from the leaf
+    positions of the private anime and the padding like count_queries. The
+    node sets reached by the depths are nested, so one traversal of their
+    union looks at each node once and attributes its query to every depth
+    that would ask it. """
+    cost = {d: NodeQueries() for d in depths}
+    # a depth stops reaching the children of an empty node below it, so the
+    # depths reaching a node are always the deepest ones, depths[first:]
+    depths = sorted(depths)
+
+    def descend(start: int, end: int, t: int, first: int) -> None:
+        """ Visits a node at depth t reached under the depths[first:]. """
+        leaf = end - start == 1
+        # depths above the node ask about it, all of them if it's a leaf
+        last = len(depths) if leaf else bisect.bisect_left(depths, t, first)
+        if last > first:
+            size = live(tree, start, end, padding)
+            # an empty node is pruned without a query
+            if size == 0:
+                return
+            for d in depths[first:last]:
+                cost[d].ask(start, end, size)
+            if leaf:
+                return
+            # children are reached if the node was skipped or was positive
+            if count_in(positives, start, end) == 0:
+                first = last
+        if first < len(depths):
+            mid = (start + end) >> 1
+            descend(start, mid, t + 1, first)
+            descend(mid, end, t + 1, first)
+
+    descend(0, len(tree), depth(tree, 0, len(tree)), 0)
+    return {d: c.totals() for d, c in cost.items()}
+
+### counting simulator: the queries traverse makes without asking the oracle
+
+def count_queries(tree: array.array, positives: list, padding: list,
+                  skip: int) -> tuple:
+    """ Computes the number of queries, total size, largest query, additions
+    and removals that traverse would use with DEPTH = skip, from the leaf
+    positions of the private anime and the padding alone. """
+    cost = NodeQueries()
+
+    def descend(start: int, end: int) -> None:
+        """ Mirrors traverse on the node [start, end). """
+        size = live(tree, start, end, padding)
+        if end - start == 1:
+            if size > 0: cost.ask(start, end, size)
+            return
+        if depth(tree, start, end) > skip:
+            # an empty node is pruned without a query
+            if size == 0: return
+            cost.ask(start, end, size)
+            if count_in(positives, start, end) == 0: return
+        mid = (start + end) >> 1
+        descend(start, mid)
+        descend(mid, end)
+
+    descend(0, len(tree))
+    return cost.totals()
+
+def sample_queries(n: int, m: int, skip: int) -> tuple:
+    """ Like count_queries on the tree of a random list of m out of n anime
+    laid out by make_tree, but without placing the leaves: the number of
+    anime and of private anime in each child is drawn from its parent's,
+    and only for the nodes traverse reaches. """
+    tree = range(1 << (n - 1).bit_length())
+    cost = NodeQueries()
+
+    def descend(start: int, end: int, size: int, hits: int) -> None:
+        """ Mirrors traverse on a node with size anime, hits in the list. """
+        # nothing under an empty node is ever asked about
+        if size == 0: return
+        if end - start == 1:
+            cost.ask(start, end, size)
+            return
+        if depth(tree, start, end) > skip:
+            cost.ask(start, end, size)
+            if hits == 0: return
+        mid = (start + end) >> 1
+        left = hypergeometric(size, end - start - size, mid - start)
+        left_hits = hypergeometric(hits, size - hits, left)
+        descend(start, mid, left, left_hits)
+        descend(mid, end, size - left, hits - left_hits)
+
+    descend(0, len(tree), n, m)
+    return cost.totals()
 
 ### part 2: determine the score of each anime
 
@@ -110,7 +471,7 @@ def plausible(u: list, dist: str) -> list:
     # pick a and b to get the closest to the mean
     if dist == "mean":
         u_mu = sum(guess)/len(guess)
-        a, b = min(poss, key=lambda p: abs(p[0]*u_mu + p[1] - MEAN))
+        a, b = min(poss, key=lambda p: abs(p[0]*u_mu + p[1] - average()))
     # perform maximum likelihood estimation to find a and b 
     else:
         counts = [guess.count(i) for i in range(11)]
@@ -119,61 +480,267 @@ def plausible(u: list, dist: str) -> list:
                 sum(counts[x]*f(p[0]*x + p[1]) for x in values))
     return list(map(lambda x: a*x + b, guess))
 
-def compute_scores(names: list, dist: str="mean") -> dict:
-    """ Compute the scores for anime in the list with repeated queries. """
-    # an empty list or a list with one element is technically a constant list  
-    if len(names) <= 1:
-        return to_list(names)
+### vectorized back end for closest/plausible/solve, requires numpy
+
+def log_pmfs() -> dict:
+    """ Table of log pmf values for each distribution, indexed by score. """
+    import numpy as np
+    # index 0 is never a valid score, give it a finite value to mask later
+    return {dist: np.array([0] + [math.log(f(x)) for x in range(1, 11)])
+            for dist, f in pmfs.items()}
+
+def norm_batch(U):
+    """ norm applied to each row of U. """
+    lo, hi = U.min(axis=1, keepdims=True), U.max(axis=1, keepdims=True)
+    a = 1/(hi - lo)
+    return a*U + -a*lo
+
+def closest_batch(U):
+    """ closest applied to each row of U, evaluating every scaling at once. """
+    import numpy as np
+    U = norm_batch(U)
+    # V[k] is the candidate for mx = k + 1, the minimum of each row is 0
+    mx = np.arange(1, 10).reshape(-1, 1, 1)
+    V = np.rint(mx*U)
+    W = norm_batch(V.reshape(-1, U.shape[1])).reshape(V.shape)
+    # cumsum adds left to right like sum, so the distances agree exactly
+    dists = np.cumsum((U - W)**2, axis=2)[:, :, -1]
+    # replay the tolerance rule of closest over the 9 scalings
+    best = np.full(len(U), np.inf)
+    choice = np.zeros(len(U), dtype=int)
+    for k in range(9):
+        better = (dists[k] < best) & (np.abs(dists[k] - best) > 10**-4)
+        best, choice = np.where(better, dists[k], best), \
+            np.where(better, k, choice)
+    return V[choice, np.arange(len(U))].astype(int) + 1
+
+def plausible_batch(U, dist: str):
+    """ plausible applied to each row of U. The candidate (a, b)'s of every
+    row are laid out as one grid in the same order as the scalar code. """
+    import numpy as np
+    guess = closest_batch(U)
+    top = guess.max(axis=1, keepdims=True)
+    a = np.repeat(np.arange(1, 11), 19).reshape(1, -1)
+    b = np.tile(np.arange(-9, 10), 10).reshape(1, -1)
+    # the minimum of every guess is 1, so the range is [1 - a, 10 - a*top]
+    valid = (a <= 10//top) & (1 - a <= b) & (b <= 10 - a*top)
+    if dist == "mean":
+        u_mu = guess.sum(axis=1, keepdims=True)/guess.shape[1]
+        key = np.where(valid, np.abs(a*u_mu + b - average()), np.inf)
+        i = key.argmin(axis=1)
+    else:
+        counts = np.stack([(guess == x).sum(axis=1) for x in range(1, 11)], 1)
+        x = np.arange(1, 11).reshape(1, 1, -1)
+        f = log_pmfs()[dist][np.clip(a[..., None]*x + b[..., None], 0, 10)]
+        # scores missing from the guess add 0, the rest add in order like sum
+        ll = np.cumsum(counts[:, None, :]*f, axis=2)[:, :, -1]
+        i = np.where(valid, ll, -np.inf).argmax(axis=1)
+    return a[0, i, None]*guess + b[0, i, None]
+
+def solve_batch(B):
+    """ solve applied to each row of B. """
+    import numpy as np
+    B = np.asarray(B, dtype=float)
+    zeros = np.zeros((len(B), 1))
+    return np.cumsum(np.hstack([zeros, B[:, ::-1]]), axis=1)[:, ::-1]
+
+def reconstruct(bs: list, dist: str="mean") -> list:
+    """ Computes plausible(solve(b), dist) for every b in bs at once, where
+    a None b is a constant list. Equal length b's are stacked together. """
+    us = [None]*len(bs)
+    lengths = {len(b) for b in bs if b is not None}
+    for n in lengths:
+        rows = [i for i, b in enumerate(bs) if b is not None and len(b) == n]
+        U = plausible_batch(solve_batch([bs[i] for i in rows]), dist)
+        for i, u in zip(rows, U.tolist()):
+            us[i] = u
+    return us
+
+def correlation_steps(names: list, deferred: query.DeferredLog=None):
+    """ Yields the session to query for each correlation used to solve for
+    the scores of the batch and is sent back the correlation. Returns the
+    correlations, None if the private list is constant on the batch. The
+    session records its queries in deferred, if given. """
     # mean and how far to deviate from the mean
     m, mu, delta = len(names), 5, 1
     v, b = [mu]*m, []
-    q = to_list(names, v)
+    # only three scores change per query, so edit the list in place
+    q = Session(to_list(names, v), deferred)
     for i in range(m - 1):
         # simultaneously set the new values while resetting past values 
         v[i - 1], v[i], v[i + 1] = mu, mu + delta, mu - delta
-        q[names[i - 1]], q[names[i]], q[names[i + 1]] = v[i - 1], v[i], v[i + 1]
-        corr = query(q)[1]
-        # other list must be constant, so return constant list
+        for j in (i - 1, i, i + 1):
+            q.set(names[j], v[j])
+        corr = yield q
+        # other list must be constant
         if corr is None:
-            return to_list(names)
+            return None
         b.append(corr)
+    return b
+
+def correlations(names: list):
+    """ Queries the correlations for the batch, see correlation_steps. """
+    steps = correlation_steps(names)
+    try:
+        q = next(steps)
+        while True:
+            q = steps.send(q.query()[1])
+    except StopIteration as e:
+        return e.value
+
+async def correlations_async(names: list,
+                             deferred: query.DeferredLog=None):
+    """ correlations through the asynchronous oracle. """
+    steps = correlation_steps(names, deferred)
+    try:
+        q = next(steps)
+        while True:
+            q = steps.send((await q.aquery())[1])
+    except StopIteration as e:
+        return e.value
+
+async def gather_correlations(batches: list, jobs: int) -> list:
+    """ Queries the correlations of at most jobs batches at a time. """
+    limit = asyncio.Semaphore(jobs)
+    logs = [query.DeferredLog() for _ in batches]
+
+    async def run(anime: list, deferred: query.DeferredLog):
+        if len(anime) <= 1:
+            return None
+        async with limit:
+            return await correlations_async(anime, deferred)
+
+    bs = await asyncio.gather(*map(run, batches, logs))
+    # interleaved queries would be charged transitions against each other,
+    # so record each batch's queries in order like a sequential run
+    for deferred in logs:
+        deferred.commit()
+    return bs
+
+def compute_scores(names: list, dist: str="mean") -> dict:
+    """ Compute the scores for anime in the list with repeated queries. """
+    # an empty list or a list with one element is technically a constant list  
+    if len(names) <= 1:
+        return to_list(names)
+    b = correlations(names)
+    # other list must be constant, so return constant list
+    if b is None:
+        return to_list(names)
     # u is of the form ax + b, where x is the ground truth and a > 0
     u = plausible(solve(b), dist)
     return to_list(names, u)
 
-def batch_compute(names: list, dist: str="mean", batch_size: int=128) -> dict:
-    """ Split up a large list into batches to be used in compute_scores. """
+def batch_compute(names: list, dist: str="mean", batch_size: int=128,
+                  jobs: int=1) -> dict:
+    """ Split up a large list into batches to be used in compute_scores.
+    Batches of batch_size are cut like stream_batches, so the scores agree
+    with pipeline_compute. If batch_size is None, the list is split evenly
+    into the number of batches picked by the error model in prob.py,
+    assuming the MAL distribution if dist is the mean; the pipeline can't
+    plan without the size of the list, so the two modes may differ then.
+    The batches are independent, so jobs of them can be queried at once. """
     n = len(names)
-    num_batches = math.ceil(n/batch_size)
-    size = n//num_batches
-    # spread the at most num_batches leftover elements over the first batches
-    loss = n - size*num_batches
-    scores, cur = [], 0
-    for i in range(num_batches):
-        cur_size = size + (i < loss)
-        anime = names[cur: cur + cur_size]
-        result = compute_scores(anime, dist)
-        scores += [result[name] for name in anime]
-        cur += cur_size
+    if batch_size is None:
+        num_batches = plan_batches(n, dist if dist in pmfs else "mal", TARGET)
+        size = n//num_batches
+        # spread the leftover elements over the first batches
+        loss = n - size*num_batches
+        batches, cur = [], 0
+        for i in range(num_batches):
+            cur_size = size + (i < loss)
+            batches.append(names[cur: cur + cur_size])
+            cur += cur_size
+    else:
+        batches = list(stream_batches(names, batch_size))
+    # query every batch first, then solve them; the simulated latency is
+    # only paid by async queries, so a single job takes that path too
+    if jobs > 1 or query.LATENCY > 0:
+        bs = asyncio.run(gather_correlations(batches, jobs))
+    else:
+        bs = [correlations(anime) if len(anime) > 1 else None
+              for anime in batches]
+    if VECTORIZE:
+        us = reconstruct(bs, dist)
+    else:
+        us = [None if b is None else plausible(solve(b), dist) for b in bs]
+    scores = []
+    for anime, u in zip(batches, us):
+        scores += [round(average())]*len(anime) if u is None else u
     return to_list(names, scores)
 
+def stream_batches(names, batch_size: int=128):
+    """ Yields batches of names from a stream as soon as they are complete.
+    A batch is held back until half a batch more has arrived so the last
+    two batches can be balanced instead of leaving a tiny last batch. """
+    buffer = []
+    for name in names:
+        buffer.append(name)
+        if len(buffer) >= batch_size + batch_size//2:
+            yield buffer[:batch_size]
+            buffer = buffer[batch_size:]
+    # at most 1.5 batches are left, split evenly if more than one batch
+    if len(buffer) > batch_size:
+        half = (len(buffer) + 1)//2
+        yield buffer[:half]
+        buffer = buffer[half:]
+    if len(buffer) > 0:
+        yield buffer
+
+def pipeline_compute(names, dist: str="mean", batch_size: int=128) -> dict:
+    """ Computes the scores of each batch as soon as the stream of names
+    fills it, rather than waiting for the entire list. The batches are
+    those of batch_compute with the same batch_size. """
+    user_list = {}
+    for batch in stream_batches(names, batch_size):
+        user_list.update(compute_scores(batch, dist))
+    return user_list
+
 if __name__ == "__main__":
-    print(f"part 1: determining which anime are in the private list\n{'-'*10}")
-    anime = shuffle(load_json(ANIME), SHUFFLE)
-    tree = make_tree(anime)
+    # load the oracle before shuffling so generated data is reproducible
+    query.load()
+    anime = query.anime
+    # the tree holds ids, i.e. positions in the list of possible anime
+    tree = implicit_tree(len(anime)) if IMPLICIT else \
+        make_tree(shuffle(list(range(len(anime))), SHUFFLE))
     # we can skip large queries if we assume the node will be explored anyways
     # skip too much and it'll use unnecessary queries but it's useful early on
-    # use -1 to disable skipping and (len(tree) - 1).bit_length() - 1 for naive 
+    # use -1 to disable skipping and len(tree).bit_length() - 1 for naive 
+    # None plans the depth from the catalog size and a guess of the list size
     DEPTH = 7
-    names = traverse(tree)
-    print(check(to_list(names)))
-
-    print(f"\npart 2: computing scores\n{'-'*10}")
+    if DEPTH is None: DEPTH = plan_depth(len(anime), M)[0]
     # split list into batches to avoid precision loss (only given 3 digits)
     # if too small, multiple solutions. if too large, not enough precision 
+    # None sizes the batches with the error model in prob.py instead, which
+    # the pipeline can't do without the size of the list, so it uses 128
     BATCH_SIZE = 128
-    user_list = batch_compute(names, batch_size=BATCH_SIZE)
-    print(check(user_list))
+    search = searches[SEARCH]
+    if INSTRUMENT is not None:
+        query.instrument = query.Instrument(INSTRUMENT)
+
+    def emit(phase: str) -> None:
+        """ Writes the instrumentation counters of the phase, if enabled. """
+        if query.instrument is not None:
+            query.instrument.emit(phase=phase, search=SEARCH, depth=DEPTH)
+
+    if PIPELINE:
+        print(f"parts 1 and 2: finding anime while computing scores\n{'-'*10}")
+        names = (anime[i] for i in search(tree))
+        # the size of the list isn't known until the search is over, so the
+        # batches match the two-phase run's only with a fixed BATCH_SIZE
+        user_list = pipeline_compute(names, batch_size=BATCH_SIZE or 128)
+        emit("pipeline")
+        print(check(user_list))
+    else:
+        print("part 1: determining which anime are in the private list")
+        print("-"*10)
+        names = [anime[i] for i in search(tree)]
+        emit("part 1")
+        print(check(to_list(names)))
+
+        print(f"\npart 2: computing scores\n{'-'*10}")
+        user_list = batch_compute(names, batch_size=BATCH_SIZE, jobs=JOBS)
+        emit("part 2")
+        print(check(user_list))
     print("\nprivate list reverse engineered!\nsaving as private-list.json...")
     if WRITE: write_json("private-list.json", user_list)
 
@@ -0,0 +1,166 @@
+# benchmark the oracle and the attack, tracking regressions against a baseline
+import argparse, os, random, time, tracemalloc
+from gen_test_data import gen_list, gen_user, write_json, load_json
+from attack import make_tree, traverse
+from stats import trial, score_trial
+import attack, query
+
+BASELINE = "bench.json" # default file for the recorded timings
+THRESHOLD = 0.1         # relative slowdown reported as a regression
+
+def setup(n: int, m: int, dist: str="uniform") -> list:
+    """ Installs a random database of n anime and private list of m. """
+    anime = gen_list(n)
+    query.setup(anime, gen_user(m, dist, anime))
+    attack.MEAN = query.mean()
+    return anime
+
+### benchmarks: each does its own setup and returns a function to time,
+### which returns the number of operations it performed
+
+def bench_query(size: int, repeat: int=100):
+    """ query.query on lists of the given size. """
+    anime = setup(17526, 385)
+    u = {name: random.randint(1, 10) for name in random.sample(anime, size)}
+    def run() -> int:
+        for _ in range(repeat):
+            query.query(u)
+        return repeat
+    return run
+
+def bench_traverse(n: int=17526, m: int=385, depth: int=11):
+    """ A full tree search for the private list. """
+    setup(n, m)
+    tree = make_tree(list(range(n)))
+    def run() -> int:
+        attack.DEPTH = depth
+        query.log.reset()
+        found = sum(1 for _ in traverse(tree))
+        assert found == m, "tree search missed anime"
+        return len(query.log)
+    return run
+
+def bench_scores(m: int, dist: str="mal"):
+    """ Score inference for a list of m anime. """
+    setup(m, m, dist)
+    names = list(query.private.keys())
+    def run() -> int:
+        query.log.reset()
+        attack.compute_scores(names, dist)
+        return len(query.log)
+    return run
+
+def bench_trial(number: int=3):
+    """ Throughput of stats.trial, counted in trials. """
+    def run() -> int:
+        for _ in range(number):
+            trial()
+        return number
+    return run
+
+def bench_score_trial(m: int=100, number: int=20):
+    """ Throughput of stats.score_trial, counted in trials. """
+    def run() -> int:
+        for _ in range(number):
+            score_trial(m, "mal", "mal")
+        return number
+    return run
+
+benchmarks = {
+    **{f"query_{k}": (bench_query, (k,)) for k in (10, 100, 1000, 10000)},
+    "traverse_17526_385": (bench_traverse, ()),
+    **{f"scores_{m}": (bench_scores, (m,)) for m in (128, 512, 900)},
+    "trial": (bench_trial, ()),
+    "score_trial_100": (bench_score_trial, ()),
+}
+
+def measure(name: str, repeat: int, seed: int) -> dict:
+    """ Best wall time over repeat runs, the peak memory of a separate run
+    (tracing allocations slows the code down) and operations per second. """
+    f, params = benchmarks[name]
+    best, ops = float("inf"), 0
+    for i in range(repeat + 1):
+        random.seed(f"{seed}:{name}:{i}")
+        run = f(*params)
+        if i == repeat:
+            tracemalloc.start()
+            run()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            break
+        start = time.perf_counter()
+        ops = run()
+        best = min(best, time.perf_counter() - start)
+    query.log.reset()
+    return {"time": best, "memory": peak, "ops": ops, "rate": ops/best}
+
+def run_benchmarks(args) -> dict:
+    """ Measures the selected benchmarks, printing each as it finishes. """
+    names = args.only if args.only else list(benchmarks)
+    print(f"{'benchmark':>20}, {'time (s)':>9}, {'memory (KiB)':>12}, "
+          f"{'ops/s':>10}")
+    results = {}
+    for name in names:
+        r = results[name] = measure(name, args.repeat, args.seed)
+        print(f"{name:>20}, {r['time']:>9.4f}, {r['memory']/1024:>12.1f}, "
+              f"{r['rate']:>10.1f}")
+    return results
+
+def record(args):
+    """ Runs the benchmarks and saves them as the baseline. """
+    write_json(args.baseline, run_benchmarks(args))
+
+def compare(args):
+    """ Runs the benchmarks and flags regressions against the baseline. """
+    if not os.path.exists(args.baseline):
+        raise SystemExit(f"{args.baseline} not found, "
+                         "record a baseline with bench.py run first")
+    baseline = load_json(args.baseline)
+    if not args.only:
+        args.only = [name for name in benchmarks if name in baseline]
+    results = run_benchmarks(args)
+    print(f"{'benchmark':>20}, {'time':>7}, {'memory':>7}")
+    regressions = 0
+    for name, r in results.items():
+        if name not in baseline:
+            continue
+        old = baseline[name]
+        dt = r["time"]/old["time"] - 1
+        dm = r["memory"]/max(old["memory"], 1) - 1
+        flag = [what for what, d in (("time", dt), ("memory", dm))
+                if d > args.threshold]
+        regressions += len(flag)
+        print(f"{name:>20}, {dt:>+7.1%}, {dm:>+7.1%}"
+              + (f"  REGRESSION ({', '.join(flag)})" if flag else ""))
+    if regressions:
+        raise SystemExit(f"{regressions} regression(s) above "
+                         f"{args.threshold:.0%}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Performance benchmarks.")
+    subparsers = parser.add_subparsers(title="commands")
+    # options shared by every command
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("-s", "--seed", type=int, default=1,
+                        help="set the random seed")
+    common.add_argument("-r", "--repeat", type=int, default=3,
+                        help="timed runs per benchmark, the best is kept")
+    common.add_argument("-b", "--baseline", default=BASELINE,
+                        help="file holding the baseline timings")
+    common.add_argument("-o", "--only", nargs="+", choices=benchmarks.keys(),
+                        help="run only these benchmarks")
+
+    run = subparsers.add_parser("run", parents=[common],
+                                help="record a new baseline")
+    run.set_defaults(func=record)
+
+    comp = subparsers.add_parser("compare", parents=[common],
+                                 help="compare against the baseline")
+    comp.add_argument("-t", "--threshold", type=float, default=THRESHOLD,
+                      help="relative slowdown reported as a regression")
+    comp.set_defaults(func=compare)
+
+    args = parser.parse_args()
+
+    if "func" in args:
+        args.func(args)
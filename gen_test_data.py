@@ -1,9 +1,11 @@
-import argparse, json, random, os
+import argparse, bisect, collections.abc, json, mmap, random, os, struct
 from prob import MAL
 
 random.seed(1)
 ANIME = "anime.json" # list of possible anime
 USER  = "user.json"  # user's list
+BINARY = {ANIME: "anime.bin", USER: "user.bin"} # memory-mappable versions
+POPULATION = "population.bin" # many users' lists as a sparse matrix
 
 def write_json(fname: str, data) -> None:
     """ Writes the data to a json file. """
@@ -24,13 +26,149 @@ def load_json(fname: str):
     f, args = funcs[fname]
     return f(*args)
 
+### binary formats: a catalog is a table of fixed-width names whose row is
+### the id of the anime, a user is an array of ids and an array of scores
+
+CATALOG = struct.Struct("<4sIII") # magic, number of names, width, sorted
+USERS = struct.Struct("<4sI")     # magic, number of anime
+POPULATIONS = struct.Struct("<4sQQQ") # magic, users, anime, scores stored
+
+def write_catalog(fname: str, names: list) -> None:
+    """ Writes the names as a binary catalog, id i is the ith name. """
+    data = [name.encode() for name in names]
+    width = max(map(len, data), default=0)
+    with open(fname, "wb") as f:
+        f.write(CATALOG.pack(b"MALA", len(data), width, data == sorted(data)))
+        for name in data:
+            f.write(name.ljust(width, b"\0"))
+
+def write_private(fname: str, user: dict, catalog) -> None:
+    """ Writes the user's list as ids into the catalog and their scores. """
+    ids = catalog.ids if isinstance(catalog, Catalog) else \
+        {name: i for i, name in enumerate(catalog)}
+    with open(fname, "wb") as f:
+        f.write(USERS.pack(b"MALU", len(user)))
+        f.write(struct.pack(f"<{len(user)}i", *(ids[name] for name in user)))
+        f.write(bytes(user.values()))
+
+class NameIndex(collections.abc.Mapping):
+    """ Maps names to ids in a catalog without building a dictionary. """
+
+    def __init__(self, catalog) -> None:
+        self.catalog, self.lookup = catalog, None
+
+    def __getitem__(self, name: str) -> int:
+        if self.catalog.sorted:
+            i = bisect.bisect_left(self.catalog, name)
+            if i < len(self.catalog) and self.catalog[i] == name:
+                return i
+            raise KeyError(name)
+        # unsorted catalogs fall back to a dictionary built on first use
+        if self.lookup is None:
+            self.lookup = {name: i for i, name in enumerate(self.catalog)}
+        return self.lookup[name]
+
+    def __iter__(self):
+        return iter(self.catalog)
+
+    def __len__(self) -> int:
+        return len(self.catalog)
+
+class Catalog(collections.abc.Sequence):
+    """ A binary catalog read through mmap, names are decoded on access. """
+
+    def __init__(self, fname: str) -> None:
+        with open(fname, "rb") as f:
+            self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.n, self.width, self.sorted = CATALOG.unpack_from(self.buf)
+        assert magic == b"MALA", "not a binary catalog"
+        self.names = memoryview(self.buf)[CATALOG.size:]
+        self.ids = NameIndex(self)
+
+    def __len__(self) -> int:
+        return self.n
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self.n))]
+        if i < 0: i += self.n
+        if not 0 <= i < self.n: raise IndexError("catalog index out of range")
+        name = self.names[i*self.width: (i + 1)*self.width]
+        return bytes(name).rstrip(b"\0").decode()
+
+def load_user(fname: str, catalog) -> dict:
+    """ Loads a binary user's list, ids and scores are viewed in place. """
+    with open(fname, "rb") as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, n = USERS.unpack_from(buf)
+    assert magic == b"MALU", "not a binary user list"
+    view = memoryview(buf)
+    ids = view[USERS.size: USERS.size + 4*n].cast("i")
+    scores = view[USERS.size + 4*n: USERS.size + 5*n]
+    return {catalog[i]: x for i, x in zip(ids, scores)}
+
+class Population:
+    """ The lists of many users as a compressed sparse row matrix of users
+    by anime, read through mmap: the lists of user u are the ids
+    indices[indptr[u]:indptr[u + 1]] in increasing order and their scores.
+    On disk the header is followed by indptr (int64), indices (int32) and
+    scores (uint8), each of which is viewed in place. """
+
+    def __init__(self, fname: str=POPULATION) -> None:
+        import numpy as np
+        with open(fname, "rb") as f:
+            self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.users, self.anime, nnz = POPULATIONS.unpack_from(self.buf)
+        assert magic == b"MALP", "not a binary population"
+        offset = POPULATIONS.size
+        self.indptr = np.frombuffer(self.buf, np.int64, self.users + 1, offset)
+        offset += 8*(self.users + 1)
+        self.indices = np.frombuffer(self.buf, np.int32, nnz, offset)
+        self.scores = np.frombuffer(self.buf, np.uint8, nnz, offset + 4*nnz)
+
+    def __len__(self) -> int:
+        return self.users
+
+    def __getitem__(self, u: int) -> dict:
+        """ The list of user u as a dictionary of ids to scores. """
+        start, end = self.indptr[u], self.indptr[u + 1]
+        return dict(zip(self.indices[start:end].tolist(),
+                        self.scores[start:end].tolist()))
+
+def load_data(fname: str):
+    """ Loads the catalog or user's list, preferring the binary format. """
+    if not os.path.exists(BINARY[ANIME]):
+        # binary ids only have meaning against the binary catalog
+        if os.path.exists(BINARY[USER]):
+            raise SystemExit(f"{BINARY[USER]} found without {BINARY[ANIME]}, "
+                             "generate the catalog with anime -b first")
+        return load_json(fname)
+    catalog = Catalog(BINARY[ANIME])
+    if fname == ANIME:
+        return catalog
+    if os.path.exists(BINARY[USER]):
+        return load_user(BINARY[USER], catalog)
+    if os.path.exists(USER):
+        user = load_json(USER)
+        missing = [name for name in user if name not in catalog.ids]
+        if missing:
+            raise SystemExit(f"{USER} has {len(missing)} anime missing from "
+                             f"{BINARY[ANIME]} (e.g. {missing[0]}), "
+                             "regenerate one of them")
+        return user
+    # a generated list must be drawn from the catalog the oracle loads
+    return gen_user(385, "mal", catalog)
+
 def gen_list(n: int) -> list:
     """ Generate a list of possible anime. """
     return list(f"anime{str(i).rjust(len(str(n)), '0')}" for i in range(n))
 
 def write_list(args) -> None:
     """ Write the list of anime to a file. """
-    write_json(ANIME, gen_list(args.length))
+    if args.binary:
+        write_catalog(BINARY[ANIME], gen_list(args.length))
+    else:
+        write_json(ANIME, gen_list(args.length))
 
 def gen_user(n: int, dist: str, possible: list=None) -> dict:
     """ Generate a user's list. """
@@ -40,7 +178,83 @@ def gen_user(n: int, dist: str, possible: list=None) -> dict:
 
 def write_user(args) -> None:
     """ Write the user's list to a file. """
-    write_json(USER, gen_user(args.length, args.distribution))
+    if args.binary:
+        # ids written against a json catalog would be read against anime.bin
+        if not os.path.exists(BINARY[ANIME]):
+            raise SystemExit(f"{BINARY[ANIME]} not found, "
+                             "generate the catalog with anime -b first")
+        catalog = Catalog(BINARY[ANIME])
+        user = gen_user(args.length, args.distribution, catalog)
+        write_private(BINARY[USER], user, catalog)
+    else:
+        write_json(USER, gen_user(args.length, args.distribution))
+
+def sample_batch(rng, name: str, size: int):
+    """ Samples size scores of the given distribution with numpy, rounded
+    and clamped to 1 to 10 like sample. """
+    import numpy as np
+    if name == "uniform":
+        x = rng.integers(*params[name], size)
+    elif name == "normal":
+        x = rng.normal(*params[name], size)
+    else:
+        pop, weights = params[name]
+        x = rng.choice(np.array(pop), size, p=np.array(weights))
+    return np.clip(np.rint(x), 1, 10).astype(np.uint8)
+
+def gen_lists(rng, sizes, n: int):
+    """ Picks sizes[u] distinct anime out of n for each user u, returning
+    the ids of every user concatenated, sorted within each user. """
+    import numpy as np
+    sizes = np.asarray(sizes, np.int64)
+    # redrawing could never fill a list larger than the possible anime
+    assert (sizes <= n).all(), "list larger than the possible anime"
+    keys, need = np.empty(0, np.int64), sizes
+    # draw with replacement, then redraw the duplicates that were dropped
+    while need.any():
+        users = np.repeat(np.arange(len(sizes)), need)
+        keys = np.sort(np.concatenate(
+            (keys, users*n + rng.integers(0, n, len(users)))))
+        # np.unique is much slower than sorting and masking repeats
+        keys = keys[np.concatenate(([True], keys[1:] != keys[:-1]))]
+        need = sizes - np.bincount(keys//n, minlength=len(sizes))
+    return (keys % n).astype(np.int32)
+
+def write_population(fname: str, sizes, n: int, dist: str,
+                     chunk: int=10**4, seed: int=None) -> None:
+    """ Writes the lists of len(sizes) users, user u having sizes[u] anime
+    out of n with scores from dist, generating chunk users at a time. """
+    import numpy as np
+    rng = np.random.default_rng(random.getrandbits(64) if seed is None
+                                else seed)
+    sizes = np.asarray(sizes, np.int64)
+    assert (sizes <= n).all(), "list larger than the possible anime"
+    indptr = np.concatenate(([0], np.cumsum(sizes)))
+    users, nnz = len(sizes), int(indptr[-1])
+    # sections are at fixed offsets, so each chunk is written in place
+    ids_at = POPULATIONS.size + 8*(users + 1)
+    scores_at = ids_at + 4*nnz
+    with open(fname, "wb") as f:
+        f.write(POPULATIONS.pack(b"MALP", users, n, nnz))
+        f.write(indptr.astype("<i8").tobytes())
+        f.truncate(scores_at + nnz)
+        for start in range(0, users, chunk):
+            end = min(start + chunk, users)
+            ids = gen_lists(rng, sizes[start:end], n)
+            scores = sample_batch(rng, dist, len(ids))
+            f.seek(ids_at + 4*int(indptr[start]))
+            f.write(ids.astype("<i4").tobytes())
+            f.seek(scores_at + int(indptr[start]))
+            f.write(scores.tobytes())
+
+def write_users(args) -> None:
+    """ Write the lists of many users to a file. """
+    import numpy as np
+    rng = np.random.default_rng(args.seed)
+    low = args.length if args.min_length is None else args.min_length
+    sizes = rng.integers(low, args.length + 1, args.users)
+    write_population(args.output, sizes, args.total, args.distribution,
+                     args.chunk, args.seed + 1)
 
 ### probability distributions
 
@@ -67,6 +281,8 @@ if __name__ == "__main__":
     anime = subparsers.add_parser("anime", help="generates the possible anime")
     anime.add_argument("-l", "--length", type=int, default=17526,
                        help="number of possible anime")
+    anime.add_argument("-b", "--binary", action="store_true",
+                       help="write the memory-mappable binary format")
     anime.set_defaults(func=write_list)
 
     user = subparsers.add_parser("user", help="generate a sample list")
@@ -77,8 +293,32 @@ if __name__ == "__main__":
                       help="distribution from which to sample scores")
     user.add_argument("-s", "--seed", type=int, default=1,
                       help="set the random seed")
+    user.add_argument("-b", "--binary", action="store_true",
+                      help="write the memory-mappable binary format")
     user.set_defaults(func=write_user)
 
+    users = subparsers.add_parser("population",
+                                  help="generate the lists of many users")
+    users.add_argument("-u", "--users", type=int, default=1000,
+                       help="number of users")
+    users.add_argument("-l", "--length", type=int, default=385,
+                       help="number of anime in each list")
+    users.add_argument("-m", "--min_length", type=int,
+                       help="draw each list's size uniformly from this to "
+                       "the length instead")
+    users.add_argument("-t", "--total", type=int, default=17526,
+                       help="number of possible anime")
+    users.add_argument("-d", "--distribution", choices=name_dist.keys(),
+                       default="uniform",
+                       help="distribution from which to sample scores")
+    users.add_argument("-c", "--chunk", type=int, default=10**4,
+                       help="users generated at a time, bounding memory")
+    users.add_argument("-o", "--output", default=POPULATION,
+                       help="file to write to")
+    users.add_argument("-s", "--seed", type=int, default=1,
+                       help="set the random seed")
+    users.set_defaults(func=write_users)
+
     args = parser.parse_args()
 
     if "seed" in args:
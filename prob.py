@@ -15,7 +15,7 @@ unless a full database query is done (which defeats the point...)
 NOTE: the above logic doesn't work because it isn't random:
 the algorithm prunes subtrees so later depths actually have a high likelihood
 """
-import math, random
+import functools, math, random
 
 random.seed(1)
 M = 128 # guess for the number of entries in the target list 
@@ -36,51 +36,127 @@ pmfs = {
 
 ### empirical methods
 
-def gen_binary_string(n: int, m: int=M) -> str:
-    """ Generate a binary string of length n with m 1's. """
-    ones = set(random.sample(range(n), m))
-    return "".join(str(int(i in ones)) for i in range(n))
-
 def simulate(n: int, k: int, m: int=M):
     """ Simulate having at least one 1 in the first K characters. """
-    return "1" in gen_binary_string(n, m)[:k]
+    # only the position of the first 1 matters, not the whole string
+    return min(random.sample(range(n), m)) < k
 
 def E(f, iters=10**5) -> float:
     """ Expected value by repeatedly sampling a random variable. """
     return sum(f() for i in range(iters))/iters
 
+def hypergeometric(good: int, bad: int, k: int) -> int:
+    """ Number of 1's in the first k characters of a random binary string
+    with good 1's and bad 0's, searching outwards from the most likely
+    count so the expected work is about one standard deviation. """
+    lo, hi = max(0, k - bad), min(k, good)
+    if lo == hi: return lo
+    n = good + bad
+    x = min(max((k + 1)*(good + 1)//(n + 2), lo), hi)
+    # lgamma loses ~1e-5 of the mass for n ~ 1e9, which only matters if u
+    # lands past every count, in which case the mode is returned
+    lchoose = lambda a, b: math.lgamma(a + 1) - math.lgamma(b + 1) \
+        - math.lgamma(a - b + 1)
+    p = math.exp(lchoose(good, x) + lchoose(bad, k - x) - lchoose(n, k))
+    u = random.random() - p
+    # ratios of consecutive probabilities step the two sides outwards
+    down, up, pd, pu = x, x, p, p
+    while u > 0 and (down > lo or up < hi):
+        if up < hi:
+            pu *= (good - up)*(k - up)/((up + 1)*(bad - k + up + 1))
+            up += 1
+            u -= pu
+            if u <= 0: return up
+        if down > lo:
+            pd *= down*(bad - k + down)/((good - down + 1)*(k - down + 1))
+            down -= 1
+            u -= pd
+            if u <= 0: return down
+    return x
+
 def shuffle(l: list, actually_shuffle: bool=True) -> list:
     """ Shuffles the list. """
     if actually_shuffle: random.shuffle(l)
     return l
 
+class Permutation:
+    """ A seeded bijection of [0, n) computed on demand, so a shuffle of
+    range(n) is reproducible without materializing it. A Feistel network
+    permutes the smallest even power of two above n and values outside
+    [0, n) are walked along their cycle until they land back inside. """
+
+    def __init__(self, n: int, seed: int=None, rounds: int=4) -> None:
+        if seed is None: seed = random.getrandbits(64)
+        rng = random.Random(seed)
+        self.n, self.keys = n, [rng.getrandbits(64) for _ in range(rounds)]
+        self.half = max(1, (n - 1).bit_length() + 1 >> 1)
+        self.mask = (1 << self.half) - 1
+
+    def __round(self, x: int, key: int) -> int:
+        """ Mixes half of the bits with the round key. """
+        x = (x ^ key)*0x9E3779B97F4A7C15 & 0xFFFFFFFFFFFFFFFF
+        return (x ^ x >> 29) & self.mask
+
+    def __forward(self, x: int) -> int:
+        l, r = x >> self.half, x & self.mask
+        for key in self.keys:
+            l, r = r, l ^ self.__round(r, key)
+        return l << self.half | r
+
+    def __backward(self, x: int) -> int:
+        l, r = x >> self.half, x & self.mask
+        for key in reversed(self.keys):
+            l, r = r ^ self.__round(l, key), l
+        return l << self.half | r
+
+    def __call__(self, x: int) -> int:
+        """ The image of x. """
+        x = self.__forward(x)
+        while x >= self.n:
+            x = self.__forward(x)
+        return x
+
+    def inverse(self, y: int) -> int:
+        """ The x whose image is y. """
+        y = self.__backward(y)
+        while y >= self.n:
+            y = self.__backward(y)
+        return y
+
 ### analytical methods
 
 def choose(n: int, k: int) -> int:
     """ n choose k. """
-    r = 1
-    for i in range(n, n - k, -1):
-        r *= i
-    return r/math.factorial(k)
+    return math.comb(n, k)
+
+def log_ratio(n: int, a: int, b: int) -> float:
+    """ Natural log of choose(n - a, b)/choose(n, b), -inf if it is zero. """
+    if a + b > n: return -math.inf
+    # the ratio equals choose(n - b, a)/choose(n, a), so take fewer terms
+    a, b = max(a, b), min(a, b)
+    # a product of b terms (1 - a/(n - i)), which unlike a difference of
+    # lgammas doesn't cancel catastrophically when n is large
+    total = 0
+    for i in range(b):
+        total += math.log1p(-a/(n - i))
+        # exp has underflowed to zero, the remaining terms can't matter
+        if total < -800: return -math.inf
+    return total
 
 def prob(n: int, k: int, m: int=M) -> float:
     """ Probability of < k "gap" for binary elements distributed randomly. """
-    # return 1 - choose(n - k, m)/choose(n, m)
-    # use algebraically equivalent expression but more numerically stable
-    p = 1
-    for i in range(k):
-        # could use fraction class to not lose precision here
-        p *= (n - m - i)/(n - i)
-    return 1 - p
+    # 1 - choose(n - k, m)/choose(n, m), in log space to avoid overflow
+    return -math.expm1(log_ratio(n, k, m))
+
+def hit_probs(D: int, m: int=M) -> list:
+    """ prob for a node at each depth of a tree with D levels. """
+    n = 1 << (D - 1)
+    return [prob(n, 1 << (D - 1 - d), m) for d in range(D)]
 
 def best_depth(D: int, m: int=M) -> int:
     """ Determines the largest depth which saves queries if skipped. """
-    n = 1 << (D - 1)
-    for d in range(D):
-        # number of anime covered by a node at this depth
-        k = 1 << (D - 1 - d)
-        # probability that the node covers at least one anime in the list
-        p = prob(n, k, m)
+    # probability that the node at each depth covers an anime in the list
+    for d, p in enumerate(hit_probs(D, m)):
         # if we're right: skip doing a query, -1 queries
         # if we're wrong: do extraneous queries on children, -1 + 2 = +1 queries
         ev = p*(-1) + (1 - p)*1
@@ -90,9 +166,175 @@ def best_depth(D: int, m: int=M) -> int:
             return d - 1
     return d - 1
 
+def expected_queries(N: int, m: int, skip: int) -> float:
+    """ Expected number of queries attack.traverse makes with DEPTH = skip
+    on a shuffled tree of N anime, m of which are in the list. A node at
+    depth t > skip is asked about if its parent was skipped or held an anime
+    in the list, unless all of its leaves are padding. """
+    L = (N - 1).bit_length()
+    n, pad = 1 << L, (1 << L) - N
+    # leaves are asked about even if they're deeper than skip
+    first = max(min(skip, L - 1), -1) + 1
+    total = 0
+    for t in range(first, L + 1):
+        k = 1 << (L - t)
+        # chance that all of the node's leaves are padding
+        empty = math.exp(log_ratio(n, n - pad, k))
+        if t == first:
+            p = 1 - empty
+        else:
+            # the parent holds an anime, but not if it's only in the sibling
+            p = prob(n, 2*k, m) - (empty*prob(n - k, k, m) if empty else 0)
+        total += (1 << t)*p
+    return total
+
+@functools.lru_cache(maxsize=None)
+def plan_depth(N: int, m: int=M) -> tuple:
+    """ The skip depth minimizing the expected number of queries for a list
+    of m out of N anime, and that expected number. """
+    L = (N - 1).bit_length()
+    return min(((expected_queries(N, m, skip), skip)
+                for skip in range(-1, L)), key=lambda x: x[0])[::-1]
+
+def planning_table(totals: list, sizes: list) -> list:
+    """ Rows of N, m, planned depth and expected queries over a grid. """
+    return [(N, m, *plan_depth(N, m)) for N in totals for m in sizes
+            if m <= N]
+
+### error model for part 2: chance that a batch of scores is recovered exactly
+
+SLACK = 0.6 # drift allowed, in score steps, fit against simulated batches
+MIN_BATCH = 100 # smallest planned batch, see batch_success
+
+def moments(dist: str) -> tuple:
+    """ Mean and variance of a score distribution over the scores 1 to 10. """
+    w = [pmfs[dist](x) for x in range(1, 11)]
+    mean = sum(x*p for x, p in zip(range(1, 11), w))/sum(w)
+    return mean, sum((x - mean)**2*p for x, p in zip(range(1, 11), w))/sum(w)
+
+def inside(t: float, a: float) -> float:
+    """ Probability a Brownian motion with variance t stays within (-a, a). """
+    if t <= 0: return 1
+    p, j = 0, 1
+    while True:
+        term = math.exp(-(j*math.pi/a)**2*t/8)/j
+        p += term if j % 4 == 1 else -term
+        if term < 10**-12: break
+        j += 2
+    return min(max(4/math.pi*p, 0), 1)
+
+def batch_success(m: int, n: int, dist: str="mal") -> float:
+    """ Predicted probability that every score of a batch of m anime out of
+    a list of n is recovered exactly. Each correlation is rounded to 0.1, so
+    solve's suffix sums accumulate a random walk of uniform errors, which must
+    stay within a fraction of one score step. The batch mean differs from the
+    list mean, which picks the wrong shift if it is off by more than 0.5.
+    Small batches also often fit several scalings of the scores, which isn't
+    modeled (simulated 0.63 at m = 10 and 0.97 at m = 50, exact at 100). """
+    mean, var = moments(dist)
+    if m <= 1:
+        # a single anime is given the rounded mean
+        return pmfs[dist](round(mean))/sum(pmfs[dist](x) for x in range(1, 11))
+    # one score step in units of the correlation percentage
+    step = 100/(2*var*(m - 1))**0.5
+    p = inside((m - 1)*0.1**2/12, SLACK*step)
+    if m < n:
+        # standard deviation of the batch mean sampled without replacement
+        sd = (var/m*(n - m)/(n - 1))**0.5
+        p *= math.erf(0.5/(sd*2**0.5))
+    return p
+
+def split_success(n: int, k: int, dist: str="mal") -> float:
+    """ Predicted probability of recovering every score of a list of n split
+    evenly into k batches, like attack.batch_compute. """
+    size, loss = divmod(n, k)
+    return batch_success(size + 1, n, dist)**loss \
+        *batch_success(size, n, dist)**(k - loss)
+
+def plan_batches(n: int, dist: str="mal", target: float=0.99) -> int:
+    """ Number of batches to split a list of n into. Each batch saves a query,
+    so this is the most batches whose predicted chance of recovering every
+    score is at least target, or the likeliest number if none are. """
+    most, best, best_p = None, 1, -1
+    # batch_success is too hopeful for small batches, so don't plan any
+    for k in range(1, max(n//MIN_BATCH, 1) + 1):
+        p = split_success(n, k, dist)
+        if p >= target: most = k
+        if p > best_p: best, best_p = k, p
+        # the chance is unimodal in k, so past its peak and below target
+        # no larger k can be picked
+        elif p < target: break
+    return most if most is not None else best
+
+### vectorized Monte Carlo: hypergeometric quantities drawn in numpy batches
+
+def generator(seed: int=None):
+    """ A numpy Generator, seeded from random if no seed is given. """
+    import numpy as np
+    return np.random.default_rng(random.getrandbits(64) if seed is None
+                                 else seed)
+
+def prefix_hits(rng, size: int, n: int, k: int, m: int=M):
+    """ Number of 1's in the first k characters of size random binary
+    strings of length n with m 1's, i.e. hypergeometric draws. """
+    return rng.hypergeometric(m, n - m, k, size)
+
+@functools.lru_cache(maxsize=16)
+def gap_survival(n: int, m: int=M):
+    """ Chance the first 1 is at position k or later for k = 0, ..., n. """
+    import numpy as np
+    i = np.arange(n - m + 1)
+    # choose(n - k, m)/choose(n, m) as a running product, in log space
+    log = np.concatenate(([0], np.cumsum(np.log1p(-m/(n - i[:-1])))))
+    return np.concatenate((np.exp(log), np.zeros(m)))
+
+def first_hit(rng, size: int, n: int, m: int=M):
+    """ Position of the first 1 (the length of the leading gap of 0's) in
+    size random binary strings of length n with m 1's, by inverting the
+    survival function. """
+    import numpy as np
+    survival = gap_survival(n, m)
+    # the first 1 is at k if survival[k + 1] < u <= survival[k]
+    u = rng.random(size)
+    return len(survival) - 1 - np.searchsorted(survival[::-1], u, "left")
+
+def monte_carlo(sample, samples: int=10**7, batch: int=10**6,
+                seed: int=None) -> tuple:
+    """ Mean and standard error of a statistic, where sample(rng, size)
+    returns an array of size independent draws of it. """
+    rng, total, squares, done = generator(seed), 0.0, 0.0, 0
+    while done < samples:
+        x = sample(rng, min(batch, samples - done)).astype(float)
+        total, squares, done = total + x.sum(), squares + (x*x).sum(), \
+            done + len(x)
+    mean = float(total/done)
+    return mean, float(max(squares/done - mean*mean, 0)/done)**0.5
+
+def simulate_hit_probs(D: int, m: int=M, samples: int=10**6,
+                       seed: int=None) -> list:
+    """ Monte Carlo estimate of hit_probs, as (estimate, standard error). """
+    n = 1 << (D - 1)
+    return [monte_carlo(lambda rng, size: prefix_hits(
+                rng, size, n, 1 << (D - 1 - d), m) > 0, samples, seed=seed)
+            for d in range(D)]
+
 if __name__ == "__main__":
+    import importlib.util
+    # the Monte Carlo estimates need numpy, the rest of the demo doesn't
+    vectorized = importlib.util.find_spec("numpy") is not None
     # string of length n, m 1's, at least one 1 in the first k characters
     n, k, m = 100, 3, 5
     print(E(lambda: simulate(n, k, m)))
     print(prob(n, k, m))
-
+    if vectorized:
+        print(monte_carlo(lambda rng, size:
+                          prefix_hits(rng, size, n, k, m) > 0))
+    # the depth analysis: chance a node at each depth holds an anime
+    D, m = 15, 385
+    if not vectorized:
+        for d, p in enumerate(hit_probs(D, m)):
+            print(f"{d:>2}, {p:.6f}")
+    else:
+        for d, (p, (mc, se)) in enumerate(zip(hit_probs(D, m),
+                                              simulate_hit_probs(D, m))):
+            print(f"{d:>2}, {p:.6f}, {mc:.6f} (se {se:.6f})")
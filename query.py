@@ -1,24 +1,41 @@
-from gen_test_data import load_json, USER, ANIME
+import asyncio, collections, dataclasses, functools, json, math
+from time import perf_counter
+from gen_test_data import Catalog, load_data, USER, ANIME
 
 MIN_SIZE = 0 # minimum size to compute an affinity
-private, anime = load_json(USER), set(load_json(ANIME))
+LATENCY = 0  # seconds of simulated network delay per async query
+
+### oracle context: the possible anime and the private list, which are
+### loaded on first use unless a caller sets them up explicitly
+
+private = anime = ids = private_bits = private_scores = None
+# gives the possible anime and private list when none were set up
+loader = lambda: (load_data(ANIME), load_data(USER))
+
+def setup(names: list, user: dict) -> None:
+    """ Sets the possible anime and the private list, indexing each anime
+    by its position in names so queries can be answered with bitsets. """
+    global private, anime, ids, private_bits, private_scores
+    private, anime = user, names
+    # a binary catalog looks names up in place instead of hashing them all
+    ids = names.ids if isinstance(names, Catalog) else \
+        {name: i for i, name in enumerate(names)}
+    private_scores = {ids[name]: x for name, x in private.items()}
+    private_bits = to_bits(private_scores)
+
+def load() -> None:
+    """ Sets up the oracle from the loader if it isn't set up already. """
+    if ids is None:
+        setup(*loader())
 
 def dot(u: list, v: list) -> float:
     """ Dot product between two lists. """
     return sum(x*y for x, y in zip(u, v))
 
-def norm(u: list) -> float:
-    """ Magnitude of a vector. """
-    return dot(u, u)**0.5
-
-def scaled(u: list) -> tuple:
-    """ Subtracts the mean value of u from each element of u. """
-    mean = sum(u)/len(u) if len(u) != 0 else 0
-    return tuple(x - mean for x in u)
-
 def is_valid(u: dict) -> None:
     """ Checks whether the dictionary is a valid list. """
-    assert all(name in anime for name in u), "invalid anime names"
+    load()
+    assert all(name in ids for name in u), "invalid anime names"
     assert all(isinstance(x, int) and 0 <= x <= 10
                for x in u.values()), "invalid scores"
 
@@ -27,34 +44,371 @@ def shared_vector(u: dict, v: dict) -> tuple:
     shared = list(set(u.keys()) & set(v.keys()))
     return shared, [u[name] for name in shared], [v[name] for name in shared]
 
-log = []
+def pearson_sums(n: int, su: int, sv: int, suu: int, svv: int, suv: int):
+    """ Pearson's correlation as a rounded percentage from the sums of u, v,
+    u^2, v^2 and uv over n entries, None if the correlation is undefined. """
+    # scores are integers so every sum (and so the centered sums) are exact
+    uu, vv = n*suu - su*su, n*svv - sv*sv
+    # if one vector is constant, the correlation is undefined
+    if uu == 0 or vv == 0:
+        return None
+    return round(100*(n*suv - su*sv)/math.sqrt(uu*vv), 1)
+
+def pearson(u: list, v: list):
+    """ Pearson's correlation as a rounded percentage, None if undefined. """
+    return pearson_sums(len(u), sum(u), sum(v), dot(u, u), dot(v, v), dot(u, v))
+
+### integer id protocol: a query is a bitset over the ids of the anime
+
+def to_bits(l) -> int:
+    """ Converts an iterable of ids into a bitset, skipping negative ids. """
+    load()
+    # set bits in a buffer since or-ing into a big int copies it every time
+    buf = bytearray((len(ids) + 7) >> 3)
+    for i in l:
+        if i >= 0:
+            buf[i >> 3] |= 1 << (i & 7)
+    return int.from_bytes(buf, "little")
+
+def members(bits: int):
+    """ Yields the ids contained in the bitset in increasing order. """
+    while bits:
+        low = bits & -bits
+        yield low.bit_length() - 1
+        bits ^= low
+
+def encode(u: dict) -> tuple:
+    """ Converts a dictionary of names to scores into a bitset and scores. """
+    is_valid(u)
+    scores = {ids[name]: x for name, x in u.items()}
+    return to_bits(scores), scores
+
+def as_set(q) -> frozenset:
+    """ The ids of a query given as a bitset or a set of ids. """
+    return q if isinstance(q, frozenset) else frozenset(members(q))
+
+def is_valid_bits(bits: int, scores) -> None:
+    """ Checks whether the bitset and scores are a valid list. """
+    load()
+    assert 0 <= bits and bits >> len(ids) == 0, "invalid anime ids"
+    is_valid_scores(scores)
+
+def is_valid_ids(q: frozenset, scores) -> None:
+    """ Checks whether the set of ids and scores are a valid list. """
+    load()
+    assert all(0 <= i < len(ids) for i in q), "invalid anime ids"
+    is_valid_scores(scores)
+
+def is_valid_scores(scores) -> None:
+    """ Checks whether the scores (a dictionary or a constant) are valid. """
+    values = scores.values() if isinstance(scores, dict) else [scores]
+    assert all(isinstance(x, int) and 0 <= x <= 10
+               for x in values), "invalid scores"
+
+### query log: each query is stored as its difference from the previous one
+
+class RingSink:
+    """ Keeps the (added, removed) bitsets or id sets of the most recent
+    queries. """
+
+    def __init__(self, maxlen: int=10**4) -> None:
+        self.deltas = collections.deque(maxlen=maxlen)
+
+    def write(self, added, removed) -> None:
+        self.deltas.append((added, removed))
+
+class JsonlSink:
+    """ Streams the added and removed ids of each query to a JSON lines file. """
+
+    def __init__(self, fname: str) -> None:
+        self.f = open(fname, "w")
+
+    def write(self, added, removed) -> None:
+        delta = {"add": sorted(as_set(added)),
+                 "remove": sorted(as_set(removed))}
+        self.f.write(json.dumps(delta) + "\n")
+
+    def close(self) -> None:
+        self.f.close()
+
+class QueryLog:
+    """ Maintains query statistics incrementally as queries arrive. The
+    deltas themselves are passed to the sink, if None only counts are kept. """
+
+    def __init__(self, sink=None) -> None:
+        self.sink = sink
+        self.reset()
+
+    def reset(self) -> None:
+        """ Forgets all recorded queries. """
+        self.prev, self.n, self.size, self.largest = 0, 0, 0, None
+        self.additions = self.removals = 0
+
+    def __len__(self) -> int:
+        return self.n
+
+    def append(self, q) -> None:
+        """ Records the query given as a bitset or a frozenset of ids. """
+        size = len(q) if isinstance(q, frozenset) else q.bit_count()
+        self.size += size
+        self.largest = size if self.largest is None else max(self.largest, size)
+        # bitsets are compared in place, otherwise both sides become sets
+        if isinstance(q, int) and isinstance(self.prev, int):
+            added, removed = q & ~self.prev, self.prev & ~q
+            add, remove = added.bit_count(), removed.bit_count()
+        else:
+            prev, cur = as_set(self.prev), as_set(q)
+            added, removed = cur - prev, prev - cur
+            add, remove = len(added), len(removed)
+        # the cost of the first query is not counted as a transition
+        if self.n > 0:
+            self.additions, self.removals = \
+                self.additions + add, self.removals + remove
+        if self.sink is not None:
+            self.sink.write(added, removed)
+        self.prev, self.n = q, self.n + 1
+
+log = QueryLog()
+
+class DeferredLog:
+    """ Holds the queries of one of several concurrent sessions until commit
+    records them in the shared log, so transitions are counted as if the
+    sessions had run one after the other instead of interleaved. """
+
+    def __init__(self) -> None:
+        self.queries = []
+
+    def append(self, q) -> None:
+        self.queries.append(q)
+
+    def commit(self) -> None:
+        """ Records the held queries in the shared log, in order. """
+        for q in self.queries:
+            log.append(q)
+        self.queries.clear()
+
+### instrumentation: optional hooks on the oracle and the searches
+
+class Instrument:
+    """ Counts oracle calls, the time spent answering them against the time
+    spent by the attack, and the tree nodes visited at each depth. Each call
+    to emit writes the counters as one line of the JSON lines file. """
+
+    def __init__(self, fname: str) -> None:
+        self.f = open(fname, "a")
+        self.reset()
+
+    def reset(self) -> None:
+        """ Zeroes the counters and restarts the clock. """
+        self.calls, self.oracle_time, self.start = 0, 0, perf_counter()
+        self.nodes = collections.Counter()
+
+    def emit(self, **fields) -> None:
+        """ Writes the counters along with the given fields, then resets. """
+        wall = perf_counter() - self.start
+        record = {**fields, "calls": self.calls, "oracle_time": self.oracle_time,
+                  "attack_time": wall - self.oracle_time,
+                  "nodes": dict(sorted(self.nodes.items()))}
+        self.f.write(json.dumps(record) + "\n")
+        self.f.flush()
+        self.reset()
+
+    def close(self) -> None:
+        self.f.close()
+
+instrument = None # set to an Instrument to enable the hooks
+
+def oracle(f):
+    """ Counts and times the calls to f if instrumentation is enabled. """
+    @functools.wraps(f)
+    def timed(*args, **kwargs):
+        if instrument is None:
+            return f(*args, **kwargs)
+        start = perf_counter()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            instrument.calls += 1
+            instrument.oracle_time += perf_counter() - start
+    return timed
+
+def visit(depth: int) -> None:
+    """ Hook for the searches: records a visit to a node at the depth. """
+    if instrument is not None:
+        instrument.nodes[depth] += 1
+
+@oracle
+def query_bits(bits: int, scores) -> tuple:
+    """ Returns the number of shared anime and the Pearson's correlation,
+    where scores is either a dictionary of ids to scores or a constant. """
+    is_valid_bits(bits, scores)
+    # record the query for later postprocessing
+    log.append(bits)
+    # calculate number of shared anime with a popcount
+    shared = bits & private_bits
+    n = shared.bit_count()
+    # a constant list has an undefined correlation, skip the dot product
+    if not isinstance(scores, dict):
+        return n, None
+    # calculate Pearson's correlation over the shared anime
+    u_scores, p_scores = [], []
+    for i in members(shared):
+        u_scores.append(scores[i])
+        p_scores.append(private_scores[i])
+    return n, pearson(u_scores, p_scores) if n >= MIN_SIZE else None
+
+@oracle
+def query_ids(q: frozenset, scores) -> tuple:
+    """ query_bits for a query given as a set of ids, which costs time in
+    the size of the query rather than in the number of anime. """
+    is_valid_ids(q, scores)
+    log.append(q)
+    shared = sorted(i for i in q if i in private_scores)
+    if not isinstance(scores, dict):
+        return len(shared), None
+    u_scores = [scores[i] for i in shared]
+    p_scores = [private_scores[i] for i in shared]
+    return len(shared), \
+        pearson(u_scores, p_scores) if len(shared) >= MIN_SIZE else None
 
 def query(u: dict) -> tuple:
     """ Returns the number of shared anime and the Pearson's correlation. """
-    is_valid(u)
-    # copy and record the query for later postprocessing
-    # we could store counters to save memory but this is more compact
-    log.append({**u})
-    # calculate number of shared anime
-    shared, u_scores, p_scores = shared_vector(u, private)
-    # calculate Pearson's correlation
-    up, vp = scaled(u_scores), scaled(p_scores)
-    un, vn = norm(up), norm(vp)
-    # if one vector is constant, the correlation is undefined
-    corr = round(100*dot(up, vp)/(un*vn), 1) if un != 0 and vn != 0 else None
-    # corr = dot(up, vp)/(un*vn) if un != 0 and vn != 0 else None
-    return len(shared), corr if len(shared) >= MIN_SIZE else None
+    return query_bits(*encode(u))
 
 def mean() -> float:
     """ Returns the mean of the private list to two decimal places. """
+    load()
     return round(sum(private.values())/len(private), 2)
 
-def cost(u: dict, v: dict) -> tuple:
-    """ Return the number of additions and removals to go from u to v. """
-    u, v = set(u.keys()), set(v.keys())
-    # anime in v that's not in u is an addition
-    # anime in u that's not in v is a removal 
-    return len(v - u), len(u - v)
+class Session:
+    """ A list which is edited in place between queries. Running sums over
+    the shared anime are kept so each query costs O(changed entries).
+    Queries are recorded in the shared log, or in deferred if given. """
+
+    def __init__(self, u: dict=None, deferred: DeferredLog=None) -> None:
+        self.scores, self.bits, self.queries = {}, 0, 0
+        self.deferred = deferred
+        # number of shared anime and the sums over them for pearson_sums
+        self.n = self.su = self.sv = self.suu = self.svv = self.suv = 0
+        for name, x in ({} if u is None else u).items():
+            self.set(name, x)
+
+    def __update(self, i: int, x: int, sign: int) -> None:
+        """ Adds (sign 1) or removes (sign -1) the score x of anime i. """
+        if i in private_scores:
+            y = private_scores[i]
+            self.n += sign
+            self.su, self.sv = self.su + sign*x, self.sv + sign*y
+            self.suu, self.svv = self.suu + sign*x*x, self.svv + sign*y*y
+            self.suv += sign*x*y
+
+    def set(self, name: str, x: int) -> None:
+        """ Adds the anime to the list or changes its score. """
+        is_valid({name: x})
+        i = ids[name]
+        if i in self.scores:
+            self.__update(i, self.scores[i], -1)
+        else:
+            self.bits |= 1 << i
+        self.scores[i] = x
+        self.__update(i, x, 1)
+
+    def remove(self, name: str) -> None:
+        """ Removes the anime from the list. """
+        i = ids[name]
+        self.__update(i, self.scores.pop(i), -1)
+        self.bits ^= 1 << i
+
+    @oracle
+    def query(self) -> tuple:
+        """ Returns the number of shared anime and the Pearson's correlation
+        of the current list, exactly as query would. """
+        (log if self.deferred is None else self.deferred).append(self.bits)
+        self.queries += 1
+        corr = pearson_sums(self.n, self.su, self.sv,
+                            self.suu, self.svv, self.suv)
+        return self.n, corr if self.n >= MIN_SIZE else None
+
+    async def aquery(self) -> tuple:
+        """ query as a coroutine, answered after LATENCY seconds. """
+        await asyncio.sleep(LATENCY)
+        return self.query()
+
+### population oracle: one query answered against many private lists
+
+class PopulationOracle:
+    """ Answers each query for every user of a population at once, from the
+    users by anime matrix in compressed sparse row form (see
+    gen_test_data.Population). Every sum pearson_sums needs is a sparse
+    matrix-vector product, with the scores and their squares precomputed. """
+
+    def __init__(self, indptr, indices, scores, anime: int) -> None:
+        import numpy as np
+        self.indptr, self.indices = np.asarray(indptr), np.asarray(indices)
+        self.users, self.anime, self.queries = len(indptr) - 1, anime, 0
+        # the user of each stored score
+        self.rows = np.repeat(np.arange(self.users), np.diff(self.indptr))
+        self.scores = np.asarray(scores, np.float64)
+        self.squares = self.scores**2
+        self.keys = None
+
+    def __sum(self, weights):
+        """ Sum of the weights of each user's stored scores. """
+        import numpy as np
+        return np.bincount(self.rows, weights, self.users)
+
+    def query(self, bits, scores) -> tuple:
+        """ The number of shared anime and Pearson's correlation (nan if
+        undefined) of every user, like query_bits. The query is a bitset
+        or an array of ids and scores a dictionary of ids to scores or a
+        constant. Correlations are rounded by numpy, which can differ from
+        round in the last digit at ties. """
+        import numpy as np
+        self.queries += 1
+        if isinstance(bits, int):
+            ids = np.flatnonzero(np.unpackbits(np.frombuffer(
+                bits.to_bytes((self.anime + 7) >> 3, "little"), np.uint8),
+                bitorder="little"))
+        else:
+            ids = np.asarray(bits)
+        member = np.zeros(self.anime, bool)
+        member[ids] = True
+        shared = member[self.indices]
+        n = self.__sum(shared)
+        if not isinstance(scores, dict):
+            return n.astype(np.int64), np.full(self.users, np.nan)
+        u = np.zeros(self.anime)
+        u[list(scores)] = list(scores.values())
+        u = np.where(shared, u[self.indices], 0)
+        su, sv = self.__sum(u), self.__sum(shared*self.scores)
+        suu, svv = self.__sum(u*u), self.__sum(shared*self.squares)
+        suv = self.__sum(u*self.scores)
+        # the sums are integers well below 2^53 so this is exact
+        uu, vv = n*suu - su*su, n*svv - sv*sv
+        defined = (uu > 0) & (vv > 0) & (n >= MIN_SIZE)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            corr = np.round(100*(n*suv - su*sv)/np.sqrt(uu*vv), 1)
+        return n.astype(np.int64), np.where(defined, corr, np.nan)
+
+    def arrange(self, order) -> None:
+        """ Prepares count_leaves for leaves holding the ids in order (with
+        negative ids as padding): each user's anime are sorted by leaf. """
+        import numpy as np
+        order = np.asarray(order)
+        leaf = np.full(self.anime, -1, np.int64)
+        live = order >= 0
+        leaf[order[live]] = np.flatnonzero(live)
+        self.size = len(order)
+        self.keys = np.sort(self.rows*self.size + leaf[self.indices])
+
+    def count_leaves(self, start: int, end: int, users):
+        """ Number of shared anime of each of the users for the query of the
+        ids in leaves [start, end), in O(log) per user. """
+        import numpy as np
+        self.queries += 1
+        base = np.asarray(users, np.int64)*self.size
+        return np.searchsorted(self.keys, base + end) \
+            - np.searchsorted(self.keys, base + start)
 
 def identical(u: list, v: list) -> bool:
     """ Possible that v = au + b for some scalar a and constant vector b? """
@@ -72,32 +426,60 @@ def identical(u: list, v: list) -> bool:
     # a < 0 is not allowed because it is detectable by the sign of Pearson's
     return a >= 0 and all(abs(f(x) - y) < 10**-3 for x, y in zip(u, v))
 
-def check(u: dict, time: bool=True) -> str:
+@dataclasses.dataclass
+class Metrics:
+    """ How close a recovered list is to the private list and the queries
+    it took, as recorded by the log. """
+    anime: bool      # same anime as the private list
+    exact: bool      # scores literally identical
+    close: bool      # scores identical w.r.t. Pearson's correlation
+    accuracy: float  # fraction of shared anime with the right score
+    error: float     # average absolute score difference
+    queries: int
+    size: int        # total number of anime over all queries
+    largest: int     # number of anime in the largest query
+    additions: int
+    removals: int
+
+    @property
+    def cost(self) -> int:
+        """ Total time cost: each query and each anime added or removed. """
+        return self.queries + self.additions + self.removals
+
+    def format(self, time: bool=True) -> str:
+        """ Human readable summary, with transition costs if time. """
+        out = ["anime identical" if self.anime else "different anime"]
+        if self.exact:
+            out.append("score literally identical")
+        elif self.close:
+            out.append("score functionally identical "
+                       "w.r.t. Pearson's correlation")
+        else:
+            out.append(f"accuracy {self.accuracy:.2%}, "
+                       f"average score difference {self.error:.3f}")
+        if not time:
+            out.append(f"used {self.queries} queries, "
+                       f"avg {self.size/self.queries:.3f} anime per query")
+            out.append(f"total size {self.size}, largest query {self.largest}")
+        else:
+            out.append(f"used {self.queries} queries, {self.additions} "
+                       f"additions, {self.removals} removals")
+            out.append(f"total time cost: {self.cost}")
+        return "\n".join(out)
+
+    def __str__(self) -> str:
+        return self.format()
+
+def check(u: dict) -> Metrics:
     """ Checks whether the given list is close to the private list. """
     is_valid(u)
-    out = []
     shared, u_scores, p_scores = shared_vector(u, private)
-    out.append("anime identical" if len(u) == len(private) == len(shared) \
-          else "different anime")
-    if u_scores == p_scores:
-        out.append("score literally identical")
-    elif identical(u_scores, p_scores):
-        out.append("score functionally identical w.r.t. Pearson's correlation")
-    else:
-        acc = sum(x == y for x, y in zip(u_scores, p_scores))/len(u_scores)
-        avg = sum(abs(x - y) for x, y in zip(u_scores, p_scores))/len(u_scores)
-        out.append(f"accuracy {acc:.2%}, average score difference {avg:.3f}")
-    n, size = len(log), sum(len(u) for u in log)
-    max_queries = max(len(u) for u in log) if n > 0 else None
-    # print simple statistics about the query size
-    if not time:
-        out.append(f"used {n} queries, avg {size/n:.3f} anime per query")
-        out.append(f"total size {size}, largest query {max_queries}")
-    # compute transition costs based on history
-    else:
-        ops = map(sum, zip(*(cost(log[i], log[i + 1]) for i in range(n - 1))))
-        add, remove = list(ops) if n > 2 else (0, 0)
-        out.append(f"used {n} queries, {add} additions, {remove} removals")
-        out.append(f"total time cost: {n + add + remove}")
-    return "\n".join(out)
-
+    exact = u_scores == p_scores
+    # with no shared anime the (empty) scores are trivially exact
+    m = len(u_scores)
+    acc = sum(x == y for x, y in zip(u_scores, p_scores))/m if m else 1
+    avg = sum(abs(x - y) for x, y in zip(u_scores, p_scores))/m if m else 0
+    # transition costs are accumulated by the log as queries arrive
+    return Metrics(len(u) == len(private) == len(shared), exact,
+                   exact or identical(u_scores, p_scores), acc, avg,
+                   log.n, log.size, log.largest, log.additions, log.removals)
@@ -1,52 +1,370 @@
 # compute summary statistics about the expected number of queries
-import argparse, random, statistics, math
-from prob import shuffle
-from gen_test_data import gen_list, gen_user, write_json, load_json, name_dist
-from attack import make_tree, traverse
+import argparse, collections, contextlib, hashlib, json, multiprocessing, os
+import random, math
+import time
+from prob import shuffle, batch_success, plan_batches, split_success, \
+    plan_depth, planning_table
+from gen_test_data import gen_list, gen_user, write_json, load_json, \
+    name_dist, gen_lists, sample_batch
+from attack import make_tree, searches, count_queries, sample_queries, \
+    padding, sweep, population_traverse
 import attack, query
 
 random.seed(1)
 
-def trial(n: int=17526, m: int=385, depth: int=11, time: bool=True) -> int:
+def trial(n: int=17526, m: int=385, depth: int=11,
+          search: str="tree") -> query.Metrics:
     """ Determines the number of API calls for a random list. """
     # randomize possible anime
     anime = shuffle(gen_list(n))
-    query.anime = set(anime)
     # randomize the user's list, distribution doesn't matter
-    query.private = gen_user(m, "uniform", anime)
-    attack.MEAN = round(sum(query.private.values())/len(query.private), 2)
-    tree = make_tree(anime)
+    query.setup(anime, gen_user(m, "uniform", anime))
+    attack.MEAN = query.mean()
+    # the tree holds ids, i.e. positions in anime
+    tree = make_tree(list(range(n)))
     attack.DEPTH = depth
-    user_list = {name: 1 for name in traverse(tree)}
-    t = query.check(user_list, time=time).splitlines()
-    query.log = []
-    return t
+    user_list = {anime[i]: 1 for i in searches[search](tree)}
+    result = query.check(user_list)
+    if query.instrument is not None:
+        query.instrument.emit(trial="query", n=n, m=m, depth=depth,
+                              search=search)
+    query.log.reset()
+    return result
+
+def layout(n: int=17526, m: int=385) -> tuple:
+    """ The tree of a random list like trial's on the same seed, with the
+    sorted leaf positions of the private anime and of the padding. """
+    anime = shuffle(gen_list(n))
+    private = gen_user(m, "uniform", anime)
+    tree = make_tree(list(range(n)))
+    ids = {i for i, name in enumerate(anime) if name in private}
+    return tree, [i for i, x in enumerate(tree) if x in ids], padding(tree)
+
+def fast_trial(n: int=17526, m: int=385, depth: int=11,
+               exact: bool=False) -> tuple:
+    """ Counts the queries, total size, largest query, additions and removals
+    of a random list like trial, but without asking the oracle. Only the
+    nodes traverse reaches are sampled, unless exact, which lays out the
+    same tree as trial on the same seed to count its queries exactly. """
+    if not exact:
+        return sample_queries(n, m, depth)
+    return count_queries(*layout(n, m), depth)
+
+def sweep_trial(n: int=17526, m: int=385, depths: list=range(9, 15)) -> dict:
+    """ Queries, total size, largest query, additions and removals for each
+    depth on one random list, counted in a single pass over the tree. """
+    return sweep(*layout(n, m), depths)
 
 def score_trial(m: int, dist: str, given_dist: str) -> tuple:
     """ Determines the behavior of the score inference algorithm. """
     # size of the database doesn't matter
-    query.anime = gen_list(m)
-    query.private = gen_user(m, dist, query.anime)
-    attack.MEAN = round(sum(query.private.values())/len(query.private), 2)
+    anime = gen_list(m)
+    query.setup(anime, gen_user(m, dist, anime))
+    attack.MEAN = query.mean()
     names = list(query.private.keys())
     user_list = attack.compute_scores(names, given_dist)
-    t = query.check(user_list).splitlines()[1]
-    query.log = []
-    if "literally" in t:
-        exact, close, acc, error = 1, 1, 100, 0
-    elif "functionally" in t:
-        exact, close, acc, error = 0, 1, 100, 0
-    else:
-        acc, error = t.split(",")
-        acc, error = float(acc.split()[-1][:-1]), float(error.split()[-1])
-        exact, close = 0, 0
-    return exact, close, acc, error
+    result = query.check(user_list)
+    if query.instrument is not None:
+        query.instrument.emit(trial="score", m=m, dist=dist)
+    query.log.reset()
+    # a functionally identical list counts as entirely correct
+    if result.close:
+        return int(result.exact), 1, 100, 0
+    return 0, 0, 100*result.accuracy, result.error
+
+def batch_trial(n: int, dist: str, given_dist: str, target: float) -> tuple:
+    """ Whether a list of n is recovered exactly by the batch sizes that the
+    error model picks for the target probability. """
+    anime = gen_list(n)
+    query.setup(anime, gen_user(n, dist, anime))
+    attack.MEAN = query.mean()
+    attack.TARGET = target
+    names = list(query.private.keys())
+    user_list = attack.batch_compute(names, given_dist, batch_size=None)
+    query.log.reset()
+    return (int(user_list == query.private),)
+
+def population_trial(n: int, m: int, users: int, depth: int=11) -> tuple:
+    """ The queries of a tree search for each of many random lists, run as
+    a single batched pass over a population oracle. """
+    import numpy as np
+    rng = np.random.default_rng(random.getrandbits(64))
+    sizes = np.full(users, m)
+    indices = gen_lists(rng, sizes, n)
+    oracle = query.PopulationOracle(
+        np.concatenate(([0], np.cumsum(sizes))), indices,
+        sample_batch(rng, "uniform", len(indices)), n)
+    tree = make_tree(list(range(n)))
+    attack.DEPTH = depth
+    return population_traverse(tree, oracle)
+
+def api_calls(n: int, m: int, depth: int, fast: bool=False,
+              exact: bool=False) -> tuple:
+    """ Total number of API calls used by a trial. """
+    if fast:
+        queries, _, _, add, remove = fast_trial(n, m, depth, exact)
+        return (queries + add + remove,)
+    return (trial(n, m, depth).cost,)
+
+def compare_modes(n: int, m: int, depth: int, other: str="counts") -> tuple:
+    """ Queries and API calls of the plain search and another search
+    on the same random list. """
+    state = random.getstate()
+    plain = trial(n, m, depth)
+    random.setstate(state)
+    other = trial(n, m, depth, search=other)
+    return plain.queries, plain.cost, other.queries, other.cost
+
+### parallel trials
+
+def seeded_trial(task: tuple) -> tuple:
+    """ Runs a trial with the random state derived from its key. """
+    f, params, key = task
+    # string seeds are hashed, so each key gets an independent stream
+    random.seed(":".join(map(str, key)))
+    return f(*params)
+
+def run_trials(f, params: tuple, n: int, seed: int, jobs: int=1,
+               key: tuple=(), start: int=0, pool=None):
+    """ Yields the results of n trials of f(*params) in order, starting from
+    trial start. Trial i is seeded by (seed, *key, i), so results don't
+    depend on the number of jobs or on how the trials are split up. If pool
+    is given (see workers), it runs the trials instead of a new pool. """
+    tasks = ((f, params, (seed, *key, i)) for i in range(start, start + n))
+    if pool is None and jobs == 1:
+        yield from map(seeded_trial, tasks)
+        return
+    chunksize = max(1, min(n//(4*jobs), 256))
+    if pool is not None:
+        yield from pool.imap(seeded_trial, tasks, chunksize)
+        return
+    with multiprocessing.Pool(jobs) as pool:
+        yield from pool.imap(seeded_trial, tasks, chunksize)
+
+def workers(jobs: int):
+    """ A pool of jobs processes to share between calls of run_trials, or a
+    context giving None (trials run in this process) for a single job. """
+    return multiprocessing.Pool(jobs) if jobs > 1 else contextlib.nullcontext()
+
+class Summary:
+    """ Streaming count, means and standard deviations of result tuples. """
+
+    def __init__(self) -> None:
+        # running sums for the means, Welford's algorithm for the deviations
+        self.n, self.sums, self.means, self.m2 = 0, None, None, None
+
+    def add(self, row: tuple) -> None:
+        self.n += 1
+        if self.sums is None:
+            self.sums, self.means, self.m2 = [[0]*len(row) for _ in range(3)]
+        for i, x in enumerate(row):
+            self.sums[i] += x
+            delta = x - self.means[i]
+            self.means[i] += delta/self.n
+            self.m2[i] += delta*(x - self.means[i])
+
+    def merge(self, other) -> None:
+        """ Adds the trials summarized by other (Chan et al.'s update). """
+        if other.n == 0:
+            return
+        if self.n == 0:
+            self.n = other.n
+            self.sums, self.means, self.m2 = \
+                list(other.sums), list(other.means), list(other.m2)
+            return
+        n = self.n + other.n
+        for i in range(len(self.sums)):
+            delta = other.means[i] - self.means[i]
+            self.sums[i] += other.sums[i]
+            self.means[i] += delta*other.n/n
+            self.m2[i] += other.m2[i] + delta*delta*self.n*other.n/n
+        self.n = n
+
+    def state(self) -> tuple:
+        """ Everything needed to resume the summary. """
+        return self.n, self.sums, self.means, self.m2
+
+    def result(self) -> tuple:
+        """ The count, means and standard deviations so far. """
+        n = self.n
+        stds = [(v/(n - 1))**0.5 if n > 1 else 0 for v in self.m2]
+        return n, [x/n for x in self.sums], stds
+
+def summarize(results) -> tuple:
+    """ Count, means and standard deviations of result tuples. """
+    summary = Summary()
+    for row in results:
+        summary.add(row)
+    return summary.result()
+
+Z = 1.96     # two-sided 95% normal quantile for confidence intervals
+CHUNK = 250  # trials between checks of the confidence intervals
+
+def ci_width(n: int, std: float) -> float:
+    """ Width of the confidence interval of a mean of n trials. If no
+    variation has been seen yet, the rule of three bounds it instead. """
+    return max(2*Z*std/n**0.5, 3/n)
+
+def run_until(f, params: tuple, limit: int, width: float, scale: tuple,
+              seed: int, jobs: int=1, key: tuple=(), summary: Summary=None,
+              checkpoint=None, pool=None) -> tuple:
+    """ Summarizes trials run in chunks until the confidence interval of
+    every mean, divided by its scale, is at most width (never if None) or
+    limit trials have run. The trials are a prefix of those run_trials
+    would make. Trials already in summary are not rerun, and checkpoint is
+    called with the index of the first trial and summary of each chunk.
+    Every chunk runs on pool if given, see run_trials. """
+    if summary is None: summary = Summary()
+
+    def done() -> bool:
+        if summary.n >= limit: return True
+        if width is None or summary.n == 0: return False
+        n, _, stds = summary.result()
+        return all(ci_width(n, std)/c <= width for std, c in zip(stds, scale))
+
+    while not done():
+        chunk = Summary()
+        for row in run_trials(f, params, min(CHUNK, limit - summary.n), seed,
+                              jobs, key, summary.n, pool):
+            chunk.add(row)
+        if checkpoint is not None: checkpoint(summary.n, chunk)
+        summary.merge(chunk)
+    return summary.result()
+
+### result store: chunks of trials are saved as soon as they finish
+
+RESULTS = "stats_results.jsonl" # append-only store of trial chunks
+SOURCES = ["attack.py", "gen_test_data.py", "prob.py", "query.py", "stats.py"]
+
+def code_version() -> str:
+    """ Hash of the source files that determine the result of a trial. """
+    h = hashlib.sha1()
+    for fname in SOURCES:
+        with open(os.path.join(os.path.dirname(__file__), fname), "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()[:12]
+
+class ResultStore:
+    """ JSON lines file of trial chunks keyed by (command, distribution,
+    list size, seed, code version). A chunk is only ever appended, so a run
+    interrupted at any point loses at most the chunk in progress. """
+
+    def __init__(self, fname: str=RESULTS) -> None:
+        self.version = code_version()
+        self.chunks = collections.defaultdict(dict)
+        if os.path.exists(fname):
+            with open(fname) as f:
+                for line in f:
+                    try:
+                        chunk = json.loads(line)
+                    # the last line may have been cut off by a crash
+                    except json.JSONDecodeError:
+                        continue
+                    key = tuple(chunk["key"])
+                    self.chunks[key][chunk["start"]] = chunk["state"]
+        self.f = open(fname, "a")
+        # start on a fresh line if the last one was cut off
+        if self.f.tell() > 0:
+            with open(fname, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read() != b"\n": self.f.write("\n")
+
+    def key(self, command: str, dist: str, m: int, seed: int) -> tuple:
+        return command, dist, m, seed, self.version
+
+    def summary(self, key: tuple) -> Summary:
+        """ Merges the saved chunks of the key which form a prefix of the
+        trials, later chunks are rerun since their seeds would be skipped. """
+        summary, chunks = Summary(), self.chunks.get(key, {})
+        while summary.n in chunks:
+            chunk = Summary()
+            chunk.n, chunk.sums, chunk.means, chunk.m2 = chunks[summary.n]
+            summary.merge(chunk)
+        return summary
+
+    def append(self, key: tuple, start: int, chunk: Summary) -> None:
+        """ Saves the chunk of trials beginning at trial start. """
+        self.chunks[key][start] = chunk.state()
+        record = {"key": key, "start": start, "state": chunk.state()}
+        self.f.write(json.dumps(record) + "\n")
+        self.f.flush()
 
 def query_performance(args):
     """ Determine the average number of API calls for part 1. """
     iters, n, m, depth = args.number, args.total, args.size, args.depth
-    data = [int(trial(n, m, depth)[-1].split(":")[-1]) for i in range(iters)]
-    print(f"mean: {statistics.mean(data)}, std: {statistics.stdev(data)}")
+    if args.plan: depth = plan_depth(n, m)[0]
+    if args.compare is not None:
+        results = run_trials(compare_modes, (n, m, depth, args.compare),
+                             iters, args.seed, args.jobs)
+        _, means, stds = summarize(results)
+        for name, i in (("tree", 0), (args.compare, 2)):
+            print(f"{name:>9}: queries {means[i]:.1f} (std {stds[i]:.1f}), "
+                  f"API calls {means[i + 1]:.1f} (std {stds[i + 1]:.1f})")
+        print(f"queries saved: {1 - means[2]/means[0]:.2%}, "
+              f"API calls saved: {1 - means[3]/means[1]:.2%}")
+        return
+    results = run_trials(api_calls, (n, m, depth, args.fast, args.exact),
+                         iters, args.seed, args.jobs)
+    _, (mean,), (std,) = summarize(results)
+    print(f"mean: {mean}, std: {std}")
+
+def search_performance(args):
+    """ Compares generalized binary splitting against the tree search. """
+    print(f"{'N':>7}, {'M':>5}, {'tree q':>8}, {'tree API':>9}, "
+          f"{'split q':>8}, {'split API':>9}")
+    for n in args.totals:
+        for m in args.sizes:
+            if m > n: continue
+            depth = plan_depth(n, m)[0] if args.plan else args.depth
+            results = run_trials(compare_modes, (n, m, depth, "split"),
+                                 args.number, args.seed, args.jobs, (n, m))
+            q, api, split_q, split_api = summarize(results)[1]
+            print(f"{n:>7}, {m:>5}, {q:>8.1f}, {api:>9.1f}, "
+                  f"{split_q:>8.1f}, {split_api:>9.1f}")
+
+def population_performance(args):
+    """ Queries of the tree search over a population of users. """
+    start = time.perf_counter()
+    found, queries, batched = population_trial(args.total, args.size,
+                                               args.users, args.depth)
+    elapsed = time.perf_counter() - start
+    assert all(len(ids) == args.size for ids in found), "missed anime"
+    print(f"mean: {queries.mean()}, std: {queries.std(ddof=1)}")
+    print(f"{queries.sum()} queries over {args.users} users "
+          f"answered by {batched} batched queries in {elapsed:.2f}s")
+
+def depth_plan(args):
+    """ Prints the planned depth and expected queries over a grid of N, M,
+    checked against the counting simulator if requested. """
+    print(f"{'N':>9}, {'M':>5}, {'depth':>5}, {'expected':>9}"
+          + (f", {'simulated':>9}" if args.check else ""))
+    for n, m, depth, expected in planning_table(args.totals, args.sizes):
+        row = f"{n:>9}, {m:>5}, {depth:>5}, {expected:>9.1f}"
+        if args.check:
+            results = run_trials(fast_trial, (n, m, depth), args.check,
+                                 args.seed, args.jobs, ("plan", n, m))
+            row += f", {summarize(results)[1][0]:>9.1f}"
+        print(row)
+
+def model_performance(args, dist: str, given_dist: str) -> None:
+    """ Compares the predictions of the batch error model to simulations. """
+    print("single batch: size, predicted, simulated")
+    for m in [10, 50, 100, 200, 300, 400, 500, 600, 700, 800, 900]:
+        trials = run_trials(score_trial, (m, dist, given_dist), args.number,
+                            args.seed, args.jobs, ("model", m))
+        exact = summarize(trials)[1][0]
+        print(f"{m:>4}, {batch_success(m, m, dist):.3f}, {exact:.3f}")
+    print(f"planned batches, target {args.target}: "
+          "size, batches, predicted, simulated")
+    for n in [200, 400, 800, 1600, 3200]:
+        k = plan_batches(n, dist, args.target)
+        trials = run_trials(batch_trial, (n, dist, given_dist, args.target),
+                            args.number, args.seed, args.jobs, ("plan", n))
+        exact = summarize(trials)[1][0]
+        print(f"{n:>4}, {k:>3}, {split_success(n, k, dist):.3f}, {exact:.3f}")
+
+TABLE_SIZES = list(range(1, 10)) + list(range(10, 100, 10)) \
+    + list(range(10**2, 10**3, 10**2)) # + list(range(10**3, 10**4, 10**3))
 
 def score_performance(args):
     """ Determines the performance of score estimation for part 2. """
@@ -60,30 +378,55 @@ def score_performance(args):
     dist = args.distribution
     fname = dist + ("-nomle" if args.no_mle else "")
     given_dist = "uniform" if args.no_mle else args.distribution
+    if args.model:
+        model_performance(args, dist, given_dist)
+        return
+
+    store = ResultStore(args.results)
+    # every row shares one pool instead of starting one per chunk
+    with workers(args.jobs) as pool:
+        score_rows(args, store, pool, fname, dist, given_dist)
+
+def score_rows(args, store, pool, fname: str, dist: str,
+               given_dist: str) -> None:
+    """ Runs (or resumes from the store) the rows of the graph or table. """
+
+    def score_row(m: int, n: int, command: str) -> tuple:
+        """ Runs the trials of a row not already in the store, stopping
+        early if args.ci is set. """
+        key = store.key(command, fname, m, args.seed)
+        summary = store.summary(key)
+        # accuracy is a percentage, the rest are on the scale of scores
+        n, means, _ = run_until(
+            score_trial, (m, dist, given_dist), n, args.ci, (1, 1, 100, 1),
+            args.seed, args.jobs, (command.split("-")[-1], m), summary,
+            lambda start, chunk: store.append(key, start, chunk), pool)
+        exact, close, acc, error = means
+        print(f"{m:>4}, {exact:.3f}, {close:.3f}, {acc:>5.1f}, {error:.3f}"
+              + (f", {n:>6} trials" if args.ci is not None else ""))
+        return m, exact, close, acc, error
+
     if args.graph:
         score_data = []
         iters = [200, 150, 150, 100, 100, 75, 75, 50, 50]
         for m in range(150, 950, 50):
             n = 2*iters[m//100 - 1]
-            trials = zip(*[score_trial(m, dist, given_dist) for i in range(n)])
-            exact, close, acc, error = map(lambda l: sum(l)/len(l), trials)
-            print(f"{m:>4}, {exact:.3f}, {close:.3f}, {acc:>5.1f}, {error:.3f}")
-            score_data.append((m, exact, close, acc, error))
-        # add first few rows of table data
-        table = [tuple(row) for row in load_json(f"stats_{fname}_table.json")]
-        write_json(f"stats_{fname}_graph.json", sorted(score_data + table[:19]))
+            score_data.append(score_row(m, n, "score-graph"))
+        # the small lists come from whatever table rows are in the store
+        for m in TABLE_SIZES[:19]:
+            summary = store.summary(store.key("score-table", fname, m,
+                                              args.seed))
+            if summary.n > 0:
+                score_data.append((m, *summary.result()[1]))
+        write_json(f"stats_{fname}_graph.json", sorted(score_data))
         return
     # generate data for a table
     score_data = []
-    sizes = list(range(1, 10)) + list(range(10, 100, 10)) \
-        + list(range(10**2, 10**3, 10**2)) # + list(range(10**3, 10**4, 10**3))
     iters = [10**5, 10**3, 10]
-    for m in sizes:
+    for m in TABLE_SIZES:
+        # with args.ci these counts only bound the number of trials
         n = iters[int(math.log10(m))] + (int(10**7/(m*m)) if m > 9 else 0)
-        trials = zip(*[score_trial(m, dist, given_dist) for i in range(n)])
-        exact, close, acc, error = map(lambda l: sum(l)/len(l), trials)
-        print(f"{m:>4}, {exact:.3f}, {close:.3f}, {acc:>5.1f}, {error:.3f}")
-        score_data.append((m, exact, close, acc, error))
+        score_data.append(score_row(m, n, "score-table"))
     write_json(f"stats_{fname}_table.json", score_data)
 
 def graph_data(args):
@@ -93,10 +436,8 @@ def graph_data(args):
     # query-size trade-off
     if args.name == "query":
         x = range(9, 15)
-        y = [trial(depth=d, time=False) for d in x]
-        y = [(int(lines[-2].split()[1]), int(lines[-1].split()[2][:-1]))
-            for lines in y]
-        queries, size = zip(*y)
+        y = sweep_trial(depths=x)
+        queries, size = zip(*(y[d][:2] for d in x))
         plt.plot(x, queries, label="number of queries")
         plt.plot(x, size, label="total size of queries")
         plt.title("Query-size Trade-off")
@@ -109,7 +450,8 @@ def graph_data(args):
     # total number of operations
     elif args.name == "api":
         x = range(9, 15)
-        y = [int(trial(depth=d, time=True)[-1].split(":")[-1]) for d in x]
+        y = sweep_trial(depths=x)
+        y = [y[d][0] + y[d][3] + y[d][4] for d in x]
         plt.plot(x, y)
         plt.title("Number of API Calls vs. Depth")
         plt.ylabel("Number of API Calls")
@@ -138,6 +480,11 @@ if __name__ == "__main__":
     parser.add_argument("-v", "--version", action="version", version="1.0")
     parser.add_argument("-s", "--seed", type=int, default=1,
                         help="set the random seed")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of worker processes for trials")
+    parser.add_argument("-l", "--instrument", metavar="FILE",
+                        help="append oracle and search counters per trial "
+                        "to a JSON lines file (use with one job)")
     subparsers = parser.add_subparsers(title="commands")
 
     queries = subparsers.add_parser("query", help="query performance measures")
@@ -149,8 +496,53 @@ if __name__ == "__main__":
                        help="size of private list")
     queries.add_argument("-d", "--depth", type=int, default=11,
                        help="depth")
+    queries.add_argument("-p", "--plan", action="store_true",
+                       help="use the depth minimizing the expected queries")
+    queries.add_argument("-f", "--fast", action="store_true",
+                       help="count queries without running the attack")
+    queries.add_argument("-x", "--exact", action="store_true",
+                       help="with --fast, count the attack's own list")
+    queries.add_argument("-c", "--compare", nargs="?", const="counts",
+                       choices=[s for s in searches if s != "tree"],
+                       help="compare the tree search against another search")
     queries.set_defaults(func=query_performance)
 
+    search = subparsers.add_parser("search",
+                                   help="compare the part 1 search engines")
+    search.add_argument("-n", "--number", type=int, default=10,
+                        help="number of trials per cell")
+    search.add_argument("-t", "--totals", type=int, nargs="+",
+                        default=[1000, 4000, 17526], help="database sizes")
+    search.add_argument("-m", "--sizes", type=int, nargs="+",
+                        default=[10, 100, 385], help="private list sizes")
+    search.add_argument("-d", "--depth", type=int, default=11,
+                        help="depth for the tree search")
+    search.add_argument("-p", "--plan", action="store_true",
+                        help="use the depth minimizing the expected queries")
+    search.set_defaults(func=search_performance)
+
+    population = subparsers.add_parser(
+        "population", help="query performance over many users at once")
+    population.add_argument("-u", "--users", type=int, default=1000,
+                            help="number of users")
+    population.add_argument("-t", "--total", type=int, default=17526,
+                            help="size of database")
+    population.add_argument("-s", "--size", type=int, default=385,
+                            help="size of each private list")
+    population.add_argument("-d", "--depth", type=int, default=11,
+                            help="depth")
+    population.set_defaults(func=population_performance)
+
+    plan = subparsers.add_parser("plan", help="table of planned depths")
+    plan.add_argument("-t", "--totals", type=int, nargs="+",
+                      default=[1000, 4000, 17526, 10**5, 10**6, 10**9],
+                      help="database sizes")
+    plan.add_argument("-m", "--sizes", type=int, nargs="+",
+                      default=[10, 100, 385, 1000], help="private list sizes")
+    plan.add_argument("-c", "--check", type=int, default=0, metavar="TRIALS",
+                      help="also simulate this many trials per row")
+    plan.set_defaults(func=depth_plan)
+
     score = subparsers.add_parser("score", help="score performance measures")
     score.add_argument("-d", "--distribution", choices=name_dist.keys(),
                          default="mal", help="score distribution")
@@ -159,6 +551,17 @@ if __name__ == "__main__":
                        help="generate data to be used in a graph")
     score.add_argument("-n", "--no_mle", action="store_true",
                        help="don't use maximum likelihood estimation")
+    score.add_argument("-m", "--model", action="store_true",
+                       help="validate the batch error model by simulation")
+    score.add_argument("-t", "--target", type=float, default=0.99,
+                       help="target success probability for planned batches")
+    score.add_argument("-i", "--number", type=int, default=200,
+                       help="number of trials per row when validating")
+    score.add_argument("-r", "--results", default=RESULTS,
+                       help="result store, completed rows are not rerun")
+    score.add_argument("-c", "--ci", type=float,
+                       help="stop each row once every 95%% confidence "
+                       "interval is narrower than this")
     score.set_defaults(func=score_performance)
 
     graph = subparsers.add_parser("graph", help="graph data")
@@ -168,6 +571,8 @@ if __name__ == "__main__":
     args = parser.parse_args()
 
     random.seed(args.seed)
+    if args.instrument is not None:
+        query.instrument = query.Instrument(args.instrument)
     if "func" in args:
         args.func(args)
 